@@ -2,48 +2,55 @@
 import datetime
 import logging
 import os
+import asyncio
+import functools
+import base64
+import bisect
+import contextlib
+import contextvars
+import heapq
+import itertools
 import json
+import random
+import math
+import re
+import threading
+import time
 import uuid
+import collections
+from collections import OrderedDict
+import httpx
 from google.cloud import firestore as google_firestore
-from fastapi import FastAPI, HTTPException, Depends, status, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, status, BackgroundTasks, Response, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from starlette.background import BackgroundTask
 from jose import jwt
 from pydantic import BaseModel, ValidationError
 from typing import Optional
-import requests
-from langchain_openai import ChatOpenAI
 import dotenv
-from langchain.prompts import (
+import importlib
+from langchain_core.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
 )
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
-from langchain_anthropic import ChatAnthropic
-from langchain_mistralai import ChatMistralAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.chat_models import ChatPerplexity
-from langchain_together import ChatTogether
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
 from langchain_core.output_parsers import StrOutputParser
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 import uvicorn
-import razorpay
-from razorpay.resources.subscription import Subscription
-from razorpay.resources.customer import Customer
-from razorpay.resources.order import Order
-from razorpay.resources.payment import Payment
-import tiktoken
-from anthropic import Anthropic
-from vertexai.preview import tokenization
 import hmac
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import hashlib
 
 
@@ -58,6 +65,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Set up logging with the configured log level from environment variables or default to ERROR.
@@ -77,6 +85,73 @@ def get_environment_variable(key):
 RAZORPAY_KEY_ID = get_environment_variable("RAZOR_PAY_KEY_ID")
 RAZORPAY_KEY_SECRET = get_environment_variable("RAZOR_PAY_KEY_SECRET")
 ENABLE_PAYMENT = get_environment_variable("ENABLE_PAYMENT") == "True"
+# Load every tokenizer at startup instead of on the first request that needs it
+TOKENIZER_PRELOAD = get_environment_variable("TOKENIZER_PRELOAD") == "True"
+# Number of chat history token counts kept in memory, and whether they are also saved on the chat document
+HISTORY_TOKEN_CACHE_SIZE = int(get_environment_variable("HISTORY_TOKEN_CACHE_SIZE") or 10000)
+HISTORY_TOKEN_CACHE_PERSIST = get_environment_variable("HISTORY_TOKEN_CACHE_PERSIST") == "True"
+# Merge tokens arriving within this many milliseconds into one SSE frame, 0 sends every token
+SSE_COALESCE_MS = float(get_environment_variable("SSE_COALESCE_MS") or 0)
+# Longest window tokens are held back for when the client is slow to read the frames
+SSE_COALESCE_MAX_MS = float(get_environment_variable("SSE_COALESCE_MAX_MS") or 250)
+# Most chats or turns returned by one page of the paginated endpoints
+MAX_PAGE_SIZE = int(get_environment_variable("MAX_PAGE_SIZE") or 100)
+# Most models answering one input on /v1/chat_compare
+COMPARE_MAX_MODELS = int(get_environment_variable("COMPARE_MAX_MODELS") or 4)
+# Tokens of chat history sent to the model, also bounded by the model's context window
+# less the room kept for the answer, and whether older turns are replaced by a rolling summary
+HISTORY_TOKEN_BUDGET = int(get_environment_variable("HISTORY_TOKEN_BUDGET") or 16000)
+HISTORY_OUTPUT_RESERVE = int(get_environment_variable("HISTORY_OUTPUT_RESERVE") or 4096)
+HISTORY_SUMMARY = get_environment_variable("HISTORY_SUMMARY") == "True"
+# Start an equivalent backup model when the first token takes longer than this many seconds, 0 disables hedging.
+# Failing providers fall back to a backup, and are skipped for a while after repeated failures.
+HEDGE_TTFT_SECONDS = float(get_environment_variable("HEDGE_TTFT_SECONDS") or 0)
+PROVIDER_FALLBACK = (get_environment_variable("PROVIDER_FALLBACK") or "True") == "True"
+CIRCUIT_FAILURE_THRESHOLD = int(get_environment_variable("CIRCUIT_FAILURE_THRESHOLD") or 5)
+CIRCUIT_RESET_SECONDS = float(get_environment_variable("CIRCUIT_RESET_SECONDS") or 30)
+# Concurrent streams per provider and worker ("Together=8,Perplexity=4", the others get the default),
+# a provider being the chat model class of model_company_mapping without its Chat prefix,
+# streams per user, and the waiting line in front of a full provider before requests get a 429
+PROVIDER_CONCURRENCY = get_environment_variable("PROVIDER_CONCURRENCY") or ""
+PROVIDER_CONCURRENCY_DEFAULT = int(get_environment_variable("PROVIDER_CONCURRENCY_DEFAULT") or 64)
+USER_MAX_IN_FLIGHT = int(get_environment_variable("USER_MAX_IN_FLIGHT") or 3)
+ADMISSION_QUEUE_SIZE = int(get_environment_variable("ADMISSION_QUEUE_SIZE") or 100)
+ADMISSION_MAX_WAIT = float(get_environment_variable("ADMISSION_MAX_WAIT") or 10)
+PAYING_USERS_CACHE_TTL = int(get_environment_variable("PAYING_USERS_CACHE_TTL") or 3600)
+# Redis compatible server for the shared caches, the caches stay in process memory when unset
+REDIS_URL = get_environment_variable("REDIS_URL")
+# Conversations kept in the server side history cache and the number of turns sent to the model
+HISTORY_CACHE_SIZE = int(get_environment_variable("HISTORY_CACHE_SIZE") or 1000)
+HISTORY_CACHE_TTL = int(get_environment_variable("HISTORY_CACHE_TTL") or 86400)
+SERVER_HISTORY_MAX_TURNS = int(get_environment_variable("SERVER_HISTORY_MAX_TURNS") or 30)
+# Opt-in cache of the responses to identical prompts, answered only for temperatures up to the ceiling
+RESPONSE_CACHE = get_environment_variable("RESPONSE_CACHE") == "True"
+RESPONSE_CACHE_SIZE = int(get_environment_variable("RESPONSE_CACHE_SIZE") or 1000)
+RESPONSE_CACHE_TTL = int(get_environment_variable("RESPONSE_CACHE_TTL") or 3600)
+RESPONSE_CACHE_MAX_TEMPERATURE = float(get_environment_variable("RESPONSE_CACHE_MAX_TEMPERATURE") or 0.3)
+# Titles of new chats are generated in the background from at most this many history tokens,
+# with a local extractive title when the model takes too long or the user is low on generations
+TITLE_IN_BACKGROUND = (get_environment_variable("TITLE_IN_BACKGROUND") or "True") == "True"
+TITLE_HISTORY_TOKEN_BUDGET = int(get_environment_variable("TITLE_HISTORY_TOKEN_BUDGET") or 1000)
+TITLE_TIMEOUT = float(get_environment_variable("TITLE_TIMEOUT") or 5)
+TITLE_LOCAL_BELOW_GENERATIONS = int(get_environment_variable("TITLE_LOCAL_BELOW_GENERATIONS") or 2)
+# Seconds a user's remaining generations count is trusted for the precheck
+GENERATIONS_CACHE_TTL = int(get_environment_variable("GENERATIONS_CACHE_TTL") or 30)
+# Chats whose owner is kept in memory, and for how many seconds
+CHAT_OWNER_CACHE_SIZE = int(get_environment_variable("CHAT_OWNER_CACHE_SIZE") or 10000)
+CHAT_OWNER_CACHE_TTL = int(get_environment_variable("CHAT_OWNER_CACHE_TTL") or 3600)
+# Seconds a verified Google access token is trusted without asking Google again,
+# kept well under the one hour lifetime of the tokens
+GOOGLE_TOKEN_CACHE_TTL = int(get_environment_variable("GOOGLE_TOKEN_CACHE_TTL") or 300)
+# Share of the requests traced, the exporter of their spans ("memory" or "file"), and its settings
+TRACE_SAMPLE_RATE = float(get_environment_variable("TRACE_SAMPLE_RATE") or 0)
+TRACE_EXPORTER = get_environment_variable("TRACE_EXPORTER") or "memory"
+TRACE_FILE = get_environment_variable("TRACE_FILE") or "traces.jsonl"
+TRACE_MEMORY_SPANS = int(get_environment_variable("TRACE_MEMORY_SPANS") or 10000)
+# Bearer token required by the internal endpoints (/metrics, traces and stats), which are closed when unset
+INTERNAL_TOKEN = get_environment_variable("INTERNAL_TOKEN")
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
+FREE_GENERATIONS = 20
 
 # Initialize a Firestore client with a specific service account key file
 if get_environment_variable("ENVIRONMENT") == "dev":
@@ -87,16 +162,21 @@ else:
 
 db = firestore.client()
 
-client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
-# Create an instance of the Subscription class
-subscription = Subscription(client)
-customer = Customer(client)
+razorpay_client = None
+
+
+def get_razorpay_client():
+    """Return the Razorpay client, importing the SDK on first use."""
+    global razorpay_client
+    if razorpay_client is None:
+        import razorpay
+
+        razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+    return razorpay_client
 
 # This will just define that the Authorization header is required
 auth_scheme = HTTPBearer()
 
-anthropic = Anthropic()
-
 class ChatHistory(BaseModel):
     """Chat history model for the request and response."""
 
@@ -108,7 +188,8 @@ class ChatRequest(BaseModel):
     """Chat request model for the chat endpoint."""
 
     user_input: str
-    chat_history: list[ChatHistory]
+    # When omitted, the history of chat_id is loaded on the server
+    chat_history: Optional[list[ChatHistory]] = None
     chat_model: str = "gpt-3.5-turbo"
     temperature: float = 0.8
     chat_id: Optional[str] = None
@@ -125,6 +206,20 @@ class ChatEventStreaming(BaseModel):
     data: str
     is_final: bool
     chat_id: Optional[str] = None
+    output_tokens: Optional[int] = None
+    # the model of the answer, only set on the streams of /v1/chat_compare
+    model: Optional[str] = None
+
+class ChatCompareRequest(BaseModel):
+    """Chat compare request model, one input answered by several models."""
+
+    user_input: str
+    # When omitted, the history of chat_id is loaded on the server
+    chat_history: Optional[list[ChatHistory]] = None
+    chat_models: list[str]
+    temperature: float = 0.8
+    chat_id: Optional[str] = None
+    regenerate_message: Optional[bool] = False
 
 class ChatUserHistory(BaseModel):
     """Chat user history model for the chat history endpoint."""
@@ -149,255 +244,328 @@ class PaymentRequest(BaseModel):
     razorpay_signature: str
 
 
+# "model" is the "module:class" of the LangChain chat model, imported on first use by resolve_model_class
 model_company_mapping = {
     "gpt-3.5-turbo": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": False,
         "company": "OpenAI",
         "input_token_cost_per_million": 0.5,
-        "output_token_cost_per_million": 1.5
+        "output_token_cost_per_million": 1.5,
+        "context_window": 16385
     },
     "gpt-4-turbo-preview": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": True,
         "company": "OpenAI",
         "input_token_cost_per_million": 10.0,
-        "output_token_cost_per_million": 30.0
+        "output_token_cost_per_million": 30.0,
+        "context_window": 128000
     },
     "gpt-4o-mini": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": False,
         "company": "OpenAI",
         "input_token_cost_per_million": 0.15,
-        "output_token_cost_per_million": 0.6
+        "output_token_cost_per_million": 0.6,
+        "context_window": 128000
     },
     "gpt-4o": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": True,
         "company": "OpenAI",
         "input_token_cost_per_million": 5.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 128000
     },
     "claude-3-opus-20240229": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 15.0,
-        "output_token_cost_per_million": 75.0
+        "output_token_cost_per_million": 75.0,
+        "context_window": 200000
     },
     "claude-3-sonnet-20240229": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 3.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 200000
     },
     "claude-3-haiku-20240307": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": False,
         "company": "Anthropic",
         "input_token_cost_per_million": 0.25,
-        "output_token_cost_per_million": 1.25
+        "output_token_cost_per_million": 1.25,
+        "context_window": 200000
     },
     "claude-3-5-sonnet-20240620": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 3.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 200000
     },
     "mistral-tiny-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 0.25,
-        "output_token_cost_per_million": 0.25
+        "output_token_cost_per_million": 0.25,
+        "context_window": 32000
     },
     "mistral-small-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.7
+        "output_token_cost_per_million": 0.7,
+        "context_window": 32000
     },
     "mistral-small-2402": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 1.0,
-        "output_token_cost_per_million": 3.0
+        "output_token_cost_per_million": 3.0,
+        "context_window": 32000
     },
     "mistral-medium-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": True,
         "company": "Mistral",
         "input_token_cost_per_million": 2.7,
-        "output_token_cost_per_million": 8.1
+        "output_token_cost_per_million": 8.1,
+        "context_window": 32000
     },
     "mistral-large-2402": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": True,
         "company": "Mistral",
         "input_token_cost_per_million": 4.0,
-        "output_token_cost_per_million": 12.0
+        "output_token_cost_per_million": 12.0,
+        "context_window": 32000
     },
     "gemini-1.0-pro": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.5,
-        "output_token_cost_per_million": 1.5
+        "output_token_cost_per_million": 1.5,
+        "context_window": 30720
     },
     "gemini-1.5-flash-latest": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.35,
-        "output_token_cost_per_million": 1.05
+        "output_token_cost_per_million": 1.05,
+        "context_window": 1048576
     },
     "gemini-1.5-pro-latest": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": True,
         "company": "Google",
         "input_token_cost_per_million": 3.5,
-        "output_token_cost_per_million": 10.5
+        "output_token_cost_per_million": 10.5,
+        "context_window": 2097152
     },
     "llama-3-sonar-small-32k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": False,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 28000
     },
     "llama-3-sonar-small-32k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 32768
     },
     "llama-3-sonar-large-32k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": False,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 28000
     },
     "llama-3-sonar-large-32k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 32768
     },
     "llama-3.1-sonar-small-128k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 127072
     },
     "llama-3.1-sonar-small-128k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 131072
     },
     "llama-3.1-sonar-large-128k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 127072
     },
     "llama-3.1-sonar-large-128k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 131072
     },
     "codellama/CodeLlama-34b-Instruct-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.78,
-        "output_token_cost_per_million": 0.78
+        "output_token_cost_per_million": 0.78,
+        "context_window": 16384
     },
     "codellama/CodeLlama-70b-Instruct-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 4096
     },
     "meta-llama/Llama-2-13b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.22,
-        "output_token_cost_per_million": 0.22
+        "output_token_cost_per_million": 0.22,
+        "context_window": 4096
     },
     "meta-llama/Llama-2-70b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 4096
     },
     "meta-llama/Llama-3-8b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 8192
     },
     "meta-llama/Llama-3-70b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 8192
     },
     "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 131072
     },
     "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 131072
     },
     "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 130815
     },
     "google/gemma-2b-it": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.1,
-        "output_token_cost_per_million": 0.1
+        "output_token_cost_per_million": 0.1,
+        "context_window": 8192
     },
     "google/gemma-7b-it": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 8192
     }
 }
 
 
+model_classes = {}
+model_classes_lock = threading.Lock()
+
+
+def model_provider(chat_config):
+    """
+    The provider serving a model of model_company_mapping: the "provider" of the
+    entry, or else its chat model class without the Chat prefix, "Together" for
+    the Llama and Gemma models served by ChatTogether.
+    """
+    provider = chat_config.get('provider')
+    if provider is None:
+        model = chat_config['model']
+        class_name = model.split(':')[1] if isinstance(model, str) else getattr(model, 'func', model).__name__
+        provider = class_name.removeprefix('Chat')
+    return provider
+
+
+def resolve_model_class(model_name):
+    """
+    Return the chat model class of the model, importing its provider package on first use.
+    Entries may also hold the class (or any factory) itself.
+    """
+    model = model_company_mapping[model_name]['model']
+    if not isinstance(model, str):
+        return model
+    model_class = model_classes.get(model)
+    if model_class is None:
+        with model_classes_lock:
+            model_class = model_classes.get(model)
+            if model_class is None:
+                module_name, class_name = model.split(':')
+                model_class = getattr(importlib.import_module(module_name), class_name)
+                model_classes[model] = model_class
+    return model_class
+
+
 # Get the secret key from the environment variable
 SECRET_KEY = get_environment_variable("SECRET_KEY")
 if not SECRET_KEY:
@@ -409,471 +577,3261 @@ if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
     raise ValueError("GOOGLE_CLIENT_ID or GOOGLE_CLIENT_SECRET environment variable is not set")    
 
 
-async def add_user_to_db(user_ref, user_data):
+def format_labels(labelnames, labelvalues, extra=()):
+    """Render Prometheus labels, escaping the values."""
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    """Monotonic counter per label values, exposed in the Prometheus text format."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}" for labelvalues, value in values]
+
+
+class Histogram:
+    """Distribution of observed values per label values, with fixed buckets."""
+
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # per label values: [counts per bucket and +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        with self._lock:
+            values = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self._values.items()]
+        lines = []
+        for labelvalues, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value that goes up and down per label values."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}" for labelvalues, value in values]
+
+
+class MetricsRegistry:
     """
-    Background task to add or update the user in the database.
-    """
-    user = user_ref.get()
-    if user.exists:
-        return
-    else:
-        # add created_at to the user_data
-        user_data['created_at'] = google_firestore.SERVER_TIMESTAMP
-        user_ref.set(user_data)
+    The service metrics, rendered for Prometheus on /metrics.
 
+    Metrics are recorded once per stream or call, never per token, and kept
+    per process.
+    """
 
-def add_message_to_db(request, google_user_id, user_message, ai_message, stats):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        metric = Gauge(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+chat_ttft_seconds = metrics.histogram("chat_ttft_seconds", "Seconds from the request to the first streamed token.", ["chat_model"])
+chat_stream_seconds = metrics.histogram("chat_stream_duration_seconds", "Seconds from the request to the end of the stream.", ["chat_model"])
+chat_streams_total = metrics.counter("chat_streams_total", "Chat streams by outcome.", ["chat_model", "outcome"])
+chat_input_tokens_total = metrics.counter("chat_input_tokens_total", "Input tokens sent to the models.", ["chat_model"])
+chat_output_tokens_total = metrics.counter("chat_output_tokens_total", "Output tokens received from the models.", ["chat_model"])
+chat_cost_dollars_total = metrics.counter("chat_cost_dollars_total", "Provider cost of the chat turns in dollars.", ["chat_model"])
+generations_consumed_total = metrics.counter("generations_consumed_total", "Generations reserved by the users.")
+generations_refunded_total = metrics.counter("generations_refunded_total", "Reserved generations given back.")
+cache_requests_total = metrics.counter("cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"])
+firestore_call_seconds = metrics.histogram("firestore_call_seconds", "Latency of the Firestore calls.", ["collection", "operation"])
+admission_queue_depth = metrics.gauge("admission_queue_depth", "Chat requests waiting for a provider slot.", ["provider"])
+admission_in_flight = metrics.gauge("admission_in_flight", "Chat streams holding a provider slot.", ["provider"])
+admission_wait_seconds = metrics.histogram("admission_wait_seconds", "Seconds the admitted chat requests waited for a provider slot.", ["provider", "tier"])
+admission_rejected_total = metrics.counter("admission_rejected_total", "Chat requests refused with a 429.", ["provider", "reason"])
+
+
+class Span:
     """
-    Background task to add the chat message to the database.
+    A timed stage of a request, in the OpenTelemetry data model.
+
+    Spans are recorded only for sampled traces, the spans of the others are
+    NOOP_SPAN, which records nothing.
     """
-    chat_id = None
 
-    # Check if chat_id key exists in the request
-    if not hasattr(request, 'chat_id'):
-        logging.error('Request object does not have a chat_id attribute')
-        return None
+    sampled = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, error):
+        self.error = repr(error)
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.tracer.exporter.export(self)
+
+    def to_otlp(self):
+        """The span as an OTLP/JSON span."""
+        attributes = []
+        for key, value in self.attributes.items():
+            if isinstance(value, bool):
+                typed_value = {'boolValue': value}
+            elif isinstance(value, int):
+                typed_value = {'intValue': str(value)}
+            elif isinstance(value, float):
+                typed_value = {'doubleValue': value}
+            else:
+                typed_value = {'stringValue': str(value)}
+            attributes.append({'key': key, 'value': typed_value})
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': attributes,
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
 
-    chat_id = request.chat_id
 
-    # Check if the chat_id exists in the database in the chat_id column
-    chat_ref = db.collection('chats').where(filter=FieldFilter('chat_id', '==', chat_id)).limit(1).stream()
-    chat_data = next(chat_ref, None)
+class NoopSpan:
+    """Span of a trace that is not sampled."""
 
-    if chat_data:
-        # Check if the google_user_id matches the google_user_id in the chat
-        chat_data = chat_data.to_dict()
-        if chat_data['google_user_id'] == google_user_id:
-            try:
-                # Update the chat with the new message
-                chat_doc_ref = db.collection('chats').document(chat_id)
-                chat_doc_ref.update({
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                    'model' : request.chat_model
-                })
-                db.collection('chat_history').add({
-                    'ai_message': ai_message,
-                    'user_message': user_message,
-                    'chat_id': chat_id,
-                    'created_at': google_firestore.SERVER_TIMESTAMP,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                    'regenerate_message' : request.regenerate_message,
-                    'model' : request.chat_model,
-                    'stats' : stats
-                })
-            except Exception as e:
-                logging.error(f'Error updating chat: {e}')
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Forbidden",
-            )
-    else:
-        try:
-            # Create a new chat id and add the chat to the database
-            chat_id = str(uuid.uuid4())
-            new_chat_ref = db.collection('chats').document(chat_id)
-            new_chat_ref.set({
-                'chat_id': chat_id,
-                'google_user_id': google_user_id,
-                'created_at': google_firestore.SERVER_TIMESTAMP,
-                'updated_at': google_firestore.SERVER_TIMESTAMP,
-                'model' : request.chat_model,
-            })
-            db.collection('chat_history').add({
-                'ai_message': ai_message,
-                'user_message': user_message,
-                'chat_id': chat_id,
-                'created_at': google_firestore.SERVER_TIMESTAMP,
-                'updated_at': google_firestore.SERVER_TIMESTAMP,
-                'regenerate_message' : request.regenerate_message,
-                'model' : request.chat_model,
-                'stats' : stats
-            })
-        except Exception as e:
-            logging.error(f'Error creating new chat: {e}')
-            return None
+    sampled = False
+    trace_id = None
+    span_id = None
 
-    return chat_id
+    def set_attributes(self, **attributes):
+        pass
 
+    def record_error(self, error):
+        pass
 
-def calculate_cost(input_string, output_string, model_name):
-    """
-    Calculate the cost of the chat based on the input and output token lengths.
-    """
-    chat_config = model_company_mapping.get(model_name)
-    input_token_length = 0
-    output_token_length = 0
+    def end(self):
+        pass
 
-    if chat_config['company'] == 'OpenAI':
-        encoding = tiktoken.encoding_for_model(model_name)
-        input_token_length = len(encoding.encode(input_string))
-        output_token_length = len(encoding.encode(output_string))
-    
-    if chat_config['company'] == 'Anthropic':
-        input_token_length = anthropic.count_tokens(input_string)
-        output_token_length = anthropic.count_tokens(output_string)
-    
-    if chat_config['company'] == 'Mistral' or chat_config['company'] == 'Perplexity' or chat_config['company'] == 'Meta':
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        input_token_length = len(encoding.encode(input_string))
-        output_token_length = len(encoding.encode(output_string))
-    
-    if chat_config['company'] == 'Google':
-        tokenizer = tokenization.get_tokenizer_for_model("gemini-1.5-flash-001")
-        input_token_length = tokenizer.count_tokens(input_string).total_tokens
-        output_token_length = tokenizer.count_tokens(output_string).total_tokens
-    
-    input_cost = input_token_length * chat_config['input_token_cost_per_million'] / 1000000
-    output_cost = output_token_length * chat_config['output_token_cost_per_million'] / 1000000
-    return input_token_length, output_token_length, input_cost + output_cost
 
+NOOP_SPAN = NoopSpan()
 
-@app.exception_handler(Exception)
-async def generic_exception_handler(request, exc):
-    """Generic exception handler to catch unexpected errors."""
-    logging.error("Unexpected error occurred: %s", exc)
-    return {"message": "Internal server error", "detail": str(exc)}, 500
 
-@app.exception_handler(HTTPException)
-async def custom_http_exception_handler(request, exc: HTTPException):
-    """Custom HTTP exception handler to catch HTTP exceptions."""
-    return JSONResponse(
-        status_code=exc.status_code if exc.status_code else status.HTTP_403_FORBIDDEN,
-        content={"status": exc.status_code if exc.status_code else status.HTTP_403_FORBIDDEN, "details": exc.detail},
-    )
+class InMemorySpanExporter:
+    """Keeps the latest finished spans in memory, served by /v1/traces."""
 
-async def verify_google_token(background_tasks: BackgroundTasks, credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)):
-    """Verify the Google ID token and return the user info."""
-    if credentials:
-        token = credentials.credentials
-        try:
-            request = requests.get("https://www.googleapis.com/oauth2/v3/userinfo", headers={"Authorization": f"Bearer {token}"}, timeout=10)
+    def __init__(self, maxsize):
+        self._spans = collections.deque(maxlen=maxsize)
 
-            # Check if the request was successful
-            request.raise_for_status()
+    def export(self, span):
+        self._spans.append(span)
 
-            credentials = request.json()
-            
-            # Check if the user is in the database using the sub field, in the collection users the sub is set to google_user_id field
-            user_ref = db.collection('users').document(credentials['sub'])
-            user_data = {
-                'email': credentials['email'],
-                'username': credentials['name'],
-                'profile_picture': credentials['picture'],
-                'google_user_id': credentials['sub'],
-            }
+    def spans(self, trace_id=None):
+        return [span.to_otlp() for span in list(self._spans) if trace_id is None or span.trace_id == trace_id]
 
-            # Add or update the user in the database as a background task
-            background_tasks.add_task(add_user_to_db, user_ref, user_data)
+    def flush(self):
+        pass
 
-            return credentials
-        except ValueError as exc:
-            # Invalid token
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid or expired Google ID token",
-                headers={"WWW-Authenticate": "Bearer"},
-            ) from exc
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authorization header missing",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
 
+class OTLPFileSpanExporter:
+    """Appends the finished spans to a file as OTLP/JSON lines, one batch of spans per line."""
 
+    BATCH_SIZE = 64
 
-def get_generations(token_info: dict = Depends(verify_google_token)):
-    """Verify the number of generations left for the user."""
-    # check in user_generations collection for the user
-    user_generations_ref = db.collection('user_generations').document(token_info['sub'])
-    user_generations_data = user_generations_ref.get()
-    if user_generations_data.exists:
-        user_generations_data = user_generations_data.to_dict()
-        return user_generations_data['remaining_generations']
-    else:
-        # create a new document for the user with the remaining generations
-        user_generations_ref.set({
-            'google_user_id': token_info['sub'],
-            'remaining_generations': 20,
-            'created_at': google_firestore.SERVER_TIMESTAMP,
-            'updated_at': google_firestore.SERVER_TIMESTAMP,
-        })
-        return 20
+    def __init__(self, path, service_name="chat-with-llms"):
+        self.path = path
+        self.service_name = service_name
+        self._pending = []
+        self._lock = threading.Lock()
 
-def update_generations_left(token_info: dict = Depends(verify_google_token), generations_left: int = 30):
-    """Update the number of generations left for the user."""
-    user_generations_ref = db.collection('user_generations').document(token_info['sub'])
-    user_generations_ref.update({
-        'remaining_generations': generations_left - 1,
-        'updated_at': google_firestore.SERVER_TIMESTAMP,
-    })
+    def export(self, span):
+        with self._lock:
+            self._pending.append(span)
+            if len(self._pending) < self.BATCH_SIZE:
+                return
+            spans, self._pending = self._pending, []
+        self._write(spans)
 
+    def _write(self, spans):
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': self.service_name}, 'spans': [span.to_otlp() for span in spans]}],
+        }]})
+        with open(self.path, 'a', encoding='utf-8') as trace_file:
+            trace_file.write(line + "\n")
 
-@app.get("/auth/google", response_model=dict, tags=["Authentication Endpoints"])
-async def google_auth(idinfo: dict = Depends(verify_google_token)):
-    """Google authentication endpoint to verify the Google ID token."""
-    # create a new JWT token using sub and the secret key with expiry time of 30 days
-    token = jwt.encode({"sub": idinfo["sub"], "exp": datetime.datetime.utcnow() + datetime.timedelta(days=30)}, SECRET_KEY, algorithm="HS256")
-    return {"accessToken": token, "user": idinfo, "token_type": "Bearer"}
+    def flush(self):
+        with self._lock:
+            spans, self._pending = self._pending, []
+        if spans:
+            self._write(spans)
 
-# Example usage within your verify_token dependency
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
-    """Verify the JWT token and return the user info."""
-    if credentials:
-        token = credentials.credentials
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            return payload
-        except jwt.JWTError as exc:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid or expired token",
-            ) from exc
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authorization header missing",
-        )
-    
-@app.get("/verify", tags=["Authentication Endpoints"])
-async def verify_token_info(token_info: dict = Depends(verify_token)):
-    """Verify the JWT token and return the user info."""
-    return {"token_info": token_info}
 
+current_span = contextvars.ContextVar('current_span', default=None)
 
-@app.post("/v1/chat_event_streaming", tags=["AI Endpoints"])
-async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(verify_token)):
-    """Chat Event Streaming endpoint for the OpenAI chatbot."""
-    try:
-        # Get the chat model from the request and create the corresponding chat instance
-        chat_model = request.chat_model
-        chat_config = model_company_mapping.get(chat_model)
 
-        if not chat_config:
-            raise ValueError(f"Invalid chat model: {chat_model}")
-        
-        # check the number of generations left for the user
-        generations_left = get_generations(token_info)
-        if generations_left == 0:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Generations limit exceeded",
-            )
-        
-        chat = chat_config['model'](
-            model_name=chat_model,
-            model=chat_model,
-            temperature=request.temperature,
-        )
+class Tracer:
+    """
+    Creates the spans of the requests and hands the finished ones to the exporter.
 
+    The current span is kept in a context variable, so it follows the request
+    into awaited calls, tasks and threadpool calls started from it. A trace is
+    sampled or not as a whole, decided when its root span starts.
+    """
 
-        prompt = ChatPromptTemplate(
-            messages=[
-                # SystemMessagePromptTemplate.from_template(""),
-                MessagesPlaceholder(variable_name="chat_history"),
-                HumanMessagePromptTemplate.from_template("{user_input}"),
-            ]
-        )
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-        parser = StrOutputParser()
+    def __init__(self, exporter, sample_rate):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_span(self, name, parent=None, trace_id=None, parent_id=None, sampled=None, **attributes):
+        """Start a span, a child of parent or of the current span, without making it current."""
+        if parent is None and trace_id is None:
+            parent = current_span.get()
+        if parent is not None:
+            if not parent.sampled:
+                return NOOP_SPAN
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled:
+            return NOOP_SPAN
+        return Span(self, name, trace_id or f"{random.getrandbits(128):032x}", parent_id, attributes)
+
+    @contextlib.contextmanager
+    def use_span(self, span):
+        """Make span the current span within the block, ending it at the end of the block."""
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            if not isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+                span.record_error(error)
+            raise
+        finally:
+            span.end()
+            try:
+                current_span.reset(token)
+            except ValueError:
+                # left from another context, as when a generator is closed by the garbage collector
+                pass
+
+    def span(self, name, parent=None, **attributes):
+        """Context manager running its block in a new child span."""
+        return self.use_span(self.start_span(name, parent=parent, **attributes))
+
+    @contextlib.contextmanager
+    def activate(self, span):
+        """Make span the current span within the block, without ending it."""
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
 
-        conversation = prompt | chat | parser
 
-        # Seed the chat history with the user's input from the request
-        for chat_history in request.chat_history:
-            memory.chat_memory.add_user_message(chat_history.user_message)
-            memory.chat_memory.add_ai_message(chat_history.ai_message)
-        
-        generated_ai_message = ""
+def create_span_exporter(kind):
+    """The span exporter configured by TRACE_EXPORTER."""
+    if kind == "file":
+        return OTLPFileSpanExporter(TRACE_FILE)
+    return InMemorySpanExporter(TRACE_MEMORY_SPANS)
 
-        # convert into a total input string
-        total_input = prompt.format(chat_history=memory.buffer, user_input=request.user_input)
-        
-        # Run the conversation.invoke method in a separate thread
-        def event_streaming():
-            nonlocal generated_ai_message
-            try:
-                for token in conversation.stream({"chat_history": memory.buffer, "user_input": request.user_input}):
-                    generated_ai_message += token
-                    response = ChatEventStreaming(event="stream", data=token, is_final=False)
-                    yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
-                
-                
-                input_token_length, output_token_length, cost = calculate_cost(total_input, generated_ai_message, chat_model)
-
-                # stats for the chat
-                stats = {
-                    "input_token_length": input_token_length,
-                    "output_token_length": output_token_length,
-                    "cost": cost
-                }
-                # Database update after streaming is completed
-                chat_id = add_message_to_db(request, token_info['sub'], request.user_input, generated_ai_message, stats)
 
-                # update the remaining generations for the user
-                update_generations_left(token_info, generations_left)
+tracer = Tracer(create_span_exporter(TRACE_EXPORTER), TRACE_SAMPLE_RATE)
 
-                response = ChatEventStreaming(event="stream", data="", is_final=True, chat_id=chat_id)
-                yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
-            except uvicorn.protocols.utils.ClientDisconnected:
-                logging.info("Client disconnected.")
-                response = ChatEventStreaming(event="stream", data="", is_final=True)
-                yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
 
+class TracingMiddleware:
+    """
+    ASGI middleware running every HTTP request in a root span.
 
-        return StreamingResponse(event_streaming(), media_type="text/event-stream")
-    except ValidationError as ve:
-        # Handle validation errors specifically for better user feedback
-        logging.error("Validation error: %s", ve)
-        raise HTTPException(status_code=400, detail="Invalid request data") from ve
-    except HTTPException as he:
-        # Handle HTTP exceptions specifically for better user feedback
-        raise he
-    except Exception as e:
-        # Log and handle generic exceptions gracefully
-        logging.error("Error processing chat request: %s", e)
-        raise HTTPException(status_code=500, detail="Internal server error") from e
+    A W3C traceparent header continues the caller's trace. The span lasts until
+    the response is sent, streamed responses included.
+    """
 
+    # version-trace_id-parent_id-flags, later versions may append fields
+    TRACEPARENT = re.compile(r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?')
+
+    def __init__(self, app):
+        self.app = app
+
+    @classmethod
+    def _parent(cls, scope):
+        """The caller's trace_id, parent span id and sampled flag, all None to start a new trace."""
+        for name, value in scope.get('headers', []):
+            if name == b'traceparent':
+                match = cls.TRACEPARENT.fullmatch(value.decode('latin-1').strip())
+                if match is None:
+                    break
+                version, trace_id, parent_id, flags, extra = match.groups()
+                if version == 'ff' or (version == '00' and extra) or trace_id == '0' * 32 or parent_id == '0' * 16:
+                    break
+                return trace_id, parent_id, int(flags, 16) & 1 == 1
+        return None, None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        trace_id, parent_id, sampled = self._parent(scope)
+        span = tracer.start_span(
+            f"{scope['method']} {scope['path']}", trace_id=trace_id, parent_id=parent_id, sampled=sampled,
+            **{'http.method': scope['method'], 'http.route': scope['path']},
+        )
 
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                span.set_attributes(**{'http.status_code': message['status']})
+            await send(message)
 
-@app.get("/v1/generations", tags=["AI Endpoints"])
-async def get_generations_left(token_info: dict = Depends(verify_token)):
-    """Get the number of generations left for the user."""
-    try:
-        generations_left = get_generations(token_info)
-        return {"generations_left": generations_left}
-    except Exception as e:
-        logging.error("Error processing generations request: %s", e)
-        raise HTTPException(status_code=500, detail="Internal server error") from e
+        with tracer.use_span(span):
+            await self.app(scope, receive, send_with_status)
 
-# chat history of the user
-@app.get("/v1/chat_history", tags=["AI Endpoints"], response_model=list[ChatUserHistory])
-async def user_chat_history(page: int = 1, limit: int = 10, token_info: dict = Depends(verify_token)):
-    """Chat history endpoint for the OpenAI chatbot."""
-    try:
-        # Calculate the starting index based on the page and limit
-        start_index = (page - 1) * limit
 
-        # Get the chat history from the database with pagination
-        chat_history = []
-        chat_ref = db.collection('chats').where('google_user_id', '==', token_info['sub']).order_by('updated_at', direction=google_firestore.Query.DESCENDING).offset(start_index).limit(limit).stream()
-        for chat_data in chat_ref:
-            chat_data = chat_data.to_dict()
-            chat_history.append(ChatUserHistory(chat_id=chat_data['chat_id'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], chat_title=chat_data.get('chat_title', None) , chat_model=chat_data.get('model', 'gpt-3.5-turbo')))
-                    
-        return chat_history
-    except Exception as e:
-        # Log and handle generic exceptions gracefully
-        logging.error("Error processing chat history request: %s", e)
-        raise HTTPException(status_code=500, detail="Internal server error") from e
-    
+app.add_middleware(TracingMiddleware)
 
 
-def update_chat_title(chat_id, new_chat_title):
-    """
-    Background task to update the chat title in the database.
-    """
+@contextlib.contextmanager
+def firestore_call(collection, operation):
+    """Time and trace a Firestore call of the collection."""
+    started_at = time.perf_counter()
     try:
-        chat_doc_ref = db.collection('chats').document(chat_id)
-        chat_doc_ref.update({
-            'chat_title': new_chat_title,
-            'updated_at': google_firestore.SERVER_TIMESTAMP,
-        })
-    except Exception as e:
-        logging.error(f'Error updating chat title: {e}')
+        with tracer.span(f"firestore {operation} {collection}", **{'db.system': 'firestore', 'db.collection': collection}):
+            yield
+    finally:
+        firestore_call_seconds.observe(time.perf_counter() - started_at, collection, operation)
 
 
+def add_user_to_db(user_ref, user_data):
+    """
+    Background task to add or update the user in the database.
+    """
+    with firestore_call('users', 'get'):
+        user = user_ref.get()
+    if not user.exists:
+        # add created_at to the user_data
+        user_data['created_at'] = google_firestore.SERVER_TIMESTAMP
+        with firestore_call('users', 'set'):
+            user_ref.set(user_data)
+    known_users.set(user_data['google_user_id'], True)
 
-# title of the chat generater
-@app.post("/v1/chat_title", tags=["AI Endpoints"])
-async def chat_title(request: ChatRequest, token_info: dict = Depends(verify_token)):
-    """Chat endpoint for the OpenAI chatbot."""
-    try:
-        # Get the chat model from the request and create the corresponding chat instance
-        chat_config = model_company_mapping.get("gpt-4o-mini")
 
-        # check the number of generations left for the user
-        generations_left = get_generations(token_info)
-        if generations_left == 0:
+def allocate_chat_id(chat_id, google_user_id):
+    """
+    Return the (chat_id, new_chat) the next turn is saved under, before it is generated.
+    Unknown chat ids start a new chat, chats of other users are forbidden.
+    """
+    if chat_id:
+        chat_owner = get_chat_owner(chat_id)
+        if chat_owner == google_user_id:
+            return chat_id, False
+        if chat_owner:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
-                detail="Generations limit exceeded",
+                detail="Forbidden",
             )
-        
-        chat = chat_config['model'](
-            model_name="gpt-4o-mini",
-            model="gpt-4o-mini",
-            temperature=request.temperature,
-        )
+    chat_id = str(uuid.uuid4())
+    chat_owner_cache.set(chat_id, google_user_id)
+    return chat_id, True
 
 
-        prompt = ChatPromptTemplate(
-            messages=[
-                # SystemMessagePromptTemplate.from_template(""),
-                MessagesPlaceholder(variable_name="chat_history"),
-                HumanMessagePromptTemplate.from_template("{user_input}"),
-            ]
-        )
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-        conversation = LLMChain(llm=chat, memory=memory, prompt=prompt, verbose=False)
+def add_message_to_batch(batch, turn):
+    """
+    Add the writes of a chat turn to a Firestore write batch.
+    The chat_history document id is the turn_id, so committing a turn again is idempotent.
+    """
+    chat_doc_ref = db.collection('chats').document(turn['chat_id'])
+    if turn['new_chat']:
+        new_chat_data = {
+            'chat_id': turn['chat_id'],
+            'google_user_id': turn['google_user_id'],
+            'created_at': google_firestore.SERVER_TIMESTAMP,
+            'updated_at': google_firestore.SERVER_TIMESTAMP,
+            'model' : turn['model'],
+        }
+        if turn['token_counts']:
+            new_chat_data['token_counts'] = turn['token_counts']
+        # merge, the title may have been written before the first turn is committed
+        batch.set(chat_doc_ref, new_chat_data, merge=True)
+    else:
+        chat_update = {
+            'chat_id': turn['chat_id'],
+            'google_user_id': turn['google_user_id'],
+            'updated_at': google_firestore.SERVER_TIMESTAMP,
+            'model' : turn['model']
+        }
+        if turn['token_counts']:
+            chat_update['token_counts'] = turn['token_counts']
+        # merge, an update would fail the whole batch if the chat's first turn was dropped
+        batch.set(chat_doc_ref, chat_update, merge=True)
+
+    batch.set(db.collection('chat_history').document(turn['turn_id']), {
+        'ai_message': turn['ai_message'],
+        'user_message': turn['user_message'],
+        'chat_id': turn['chat_id'],
+        'created_at': google_firestore.SERVER_TIMESTAMP,
+        'updated_at': google_firestore.SERVER_TIMESTAMP,
+        'regenerate_message' : turn['regenerate_message'],
+        'model' : turn['model'],
+        'stats' : turn['stats']
+    })
 
-        # Seed the chat history with the user's input from the request
-        for chat_history in request.chat_history:
-            memory.chat_memory.add_user_message(chat_history.user_message)
-            memory.chat_memory.add_ai_message(chat_history.ai_message)
 
-        # Run the conversation.invoke method in a separate thread
-        response = conversation.invoke(input="Generate a concise and relevant 5-word title for the above chat based on the main topic discussed. Do not include any creative or ambiguous terms.")
+class ChatPersistenceQueue:
+    """
+    Write-behind queue saving chat turns off the request path.
 
-        # clean the response of extra "" or /
-        response["text"] = response["text"].replace('"', '').replace("/", "")
+    Turns queued within flush_interval of each other are committed together in one
+    Firestore WriteBatch. A failed batch is retried with backoff in a task of its
+    own, so the queue keeps saving the other chats meanwhile, and the later turns
+    of its chats wait for that task so each chat's turns are committed in order.
+    The turn_id of each turn makes the retries idempotent.
+    """
 
-        # Database update after streaming is completed
-        update_chat_title(request.chat_id, response["text"])
+    # A WriteBatch holds at most 500 writes and a turn takes two
+    MAX_BATCH_TURNS = 200
+
+    def __init__(self, flush_interval=0.05, max_retries=5):
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = None
+        self._worker = None
+        self._retries = set()
+        # chat_id -> the retry task committing earlier turns of the chat
+        self._blocking = {}
+
+    def submit(self, turn):
+        """
+        Queue a turn to be saved, starting the worker on first use.
+        Returns a future done once the turn is committed, or failed with
+        RuntimeError when the turn was dropped.
+        """
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            # in a context of its own, the worker outlives the request that started it
+            self._worker = loop.create_task(self._run(), context=contextvars.Context())
+        saved = loop.create_future()
+        self._queue.put_nowait((turn, saved))
+        return saved
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        turns = [await self._queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(turns) < self.MAX_BATCH_TURNS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                turns.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return turns
+
+    async def _run(self):
+        while True:
+            queued = await self._next_batch()
+            # turns of a chat with earlier turns being retried are committed after them
+            held = [item for item in queued if item[0]['chat_id'] in self._blocking]
+            queued = [item for item in queued if item[0]['chat_id'] not in self._blocking]
+            if held:
+                self._start_retry(held, 0, after={self._blocking[turn['chat_id']] for turn, _ in held})
+            if not queued:
+                continue
+            committed = set()
+            retrying = False
+            try:
+                with self._persist_span(queued):
+                    if await self._try_commit([turn for turn, _ in queued], 0):
+                        committed = {turn['turn_id'] for turn, _ in queued}
+                    else:
+                        self._start_retry(queued, 1)
+                        retrying = True
+            finally:
+                if not retrying:
+                    self._settle(queued, committed)
+
+    def _start_retry(self, queued, first_attempt, after=()):
+        # in a context of its own like the worker, the turns stay unfinished in the queue until it is done
+        retry = asyncio.get_running_loop().create_task(self._retry(queued, first_attempt, after), context=contextvars.Context())
+        self._retries.add(retry)
+        for turn, _ in queued:
+            self._blocking[turn['chat_id']] = retry
+
+        def done(task):
+            self._retries.discard(task)
+            for turn, _ in queued:
+                if self._blocking.get(turn['chat_id']) is task:
+                    del self._blocking[turn['chat_id']]
+
+        retry.add_done_callback(done)
+
+    def _settle(self, queued, committed):
+        for turn, saved in queued:
+            if not saved.done():
+                if turn['turn_id'] in committed:
+                    saved.set_result(None)
+                else:
+                    saved.set_exception(RuntimeError(f"Chat turn {turn['turn_id']} was not saved"))
+            self._queue.task_done()
+
+    @staticmethod
+    def _persist_span(queued, **attributes):
+        # traced as part of the first turn's request, the other traces are listed on the span
+        trace_parents = [turn.get('trace_parent') for turn, _ in queued]
+        linked_traces = {parent.trace_id for parent in trace_parents[1:] if parent is not None and parent.sampled}
+        return tracer.span("persist_turns", parent=trace_parents[0], turns=len(queued), linked_traces=",".join(sorted(linked_traces)), **attributes)
+
+    @staticmethod
+    def _commit_batch(turns):
+        batch = db.batch()
+        for turn in turns:
+            add_message_to_batch(batch, turn)
+        with firestore_call('chat_history', 'batch_commit'):
+            batch.commit()
+
+    async def _try_commit(self, turns, attempt):
+        try:
+            await run_in_threadpool(self._commit_batch, turns)
+            return True
+        except Exception as e:
+            logging.error(f'Error saving {len(turns)} chat turns (attempt {attempt + 1}): {e}')
+            return False
 
-        return ChatResponse(response=response["text"])
-    except ValidationError as ve:
-        # Handle validation errors specifically for better user feedback
-        logging.error("Validation error: %s", ve)
-        raise HTTPException(status_code=400, detail="Invalid request data") from ve
-    except HTTPException as he:
-        # Handle HTTP exceptions specifically for better user feedback
-        raise he
-    except Exception as e:
+    async def _retry(self, queued, first_attempt, after=()):
+        committed = set()
+        try:
+            if after:
+                await asyncio.wait(after)
+            with self._persist_span(queued, retry=True):
+                committed = await self._commit([turn for turn, _ in queued], first_attempt)
+        finally:
+            self._settle(queued, committed)
+
+    async def _commit(self, turns, first_attempt=0):
+        """Commit the turns with retries and return the turn_ids that were committed."""
+        for attempt in range(first_attempt, self.max_retries):
+            if attempt:
+                await asyncio.sleep(min(0.1 * 2 ** (attempt - 1), 5))
+            if await self._try_commit(turns, attempt):
+                return {turn['turn_id'] for turn in turns}
+        if len(turns) > 1:
+            # do not let a single bad turn drop the whole batch, the turns are committed in order
+            committed = set()
+            for turn in turns:
+                committed |= await self._commit([turn])
+            return committed
+        logging.error(f"Dropping chat turn {turns[0]['turn_id']} of chat {turns[0]['chat_id']}")
+        return set()
+
+    async def flush(self):
+        """Wait until every queued turn has been saved."""
+        if self._queue is not None and self._worker is not None and not self._worker.done():
+            await self._queue.join()
+
+
+persistence_queue = ChatPersistenceQueue()
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache with an optional time to live per entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # caches with a name report their hits and misses in the metrics
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if it is missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is not None and expires_at <= time.monotonic():
+                    del self._data[key]
+                    item = None
+                else:
+                    self._data.move_to_end(key)
+        if self.name:
+            cache_requests_total.inc(self.name, "miss" if item is None else "hit")
+        return default if item is None else value
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, evicting the least recently used entry when full."""
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def update(self, key, function, ttl=None):
+        """Atomically replace the value of key with function(value), left unchanged when it returns None."""
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            item = self._data.get(key)
+            value = None
+            if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                value = item[0]
+            value = function(value)
+            if value is not None:
+                self._data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    # The async handlers use these, in memory they need no threadpool
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def aset(self, key, value, ttl=None):
+        self.set(key, value, ttl)
+
+    async def adelete(self, key):
+        self.delete(key)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache:
+    """
+    Cache with the same interface as LRUCache, stored in a Redis compatible server
+    so that it is shared between processes. Values must be JSON serializable.
+
+    The caches of a server share one client, whose connection pool is reset in
+    the workers forked after the app was preloaded. The client blocks, the async
+    handlers call it through the threadpool with aget, aset and adelete. A Redis
+    that cannot be reached is a cache miss, not an error of the request.
+    """
+
+    _clients = {}
+
+    def __init__(self, url, namespace, ttl=None):
+        import redis
+
+        self.ttl = ttl
+        self.name = namespace
+        self._namespace = namespace
+        self._errors = redis.RedisError
+        if url not in RedisCache._clients:
+            RedisCache._clients[url] = redis.Redis.from_url(url)
+        self._client = RedisCache._clients[url]
+
+    def _key(self, key):
+        return f"{self._namespace}:{key}"
+
+    def _expiry(self, ttl):
+        ttl = ttl if ttl is not None else self.ttl
+        return int(ttl) if ttl is not None else None
+
+    def get(self, key, default=None):
+        """Return the value stored for key, or default if it is missing, expired or Redis fails."""
+        try:
+            value = self._client.get(self._key(key))
+        except self._errors as e:
+            logging.warning(f'Redis get of {self.name} failed: {e!r}')
+            value = None
+        cache_requests_total.inc(self.name, "miss" if value is None else "hit")
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, it expires after ttl seconds if set."""
+        try:
+            self._client.set(self._key(key), json.dumps(value), ex=self._expiry(ttl))
+        except self._errors as e:
+            logging.warning(f'Redis set of {self.name} failed: {e!r}')
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+        try:
+            self._client.delete(self._key(key))
+        except self._errors as e:
+            logging.warning(f'Redis delete of {self.name} failed: {e!r}')
+
+    def update(self, key, function, ttl=None):
+        """Atomically replace the value of key with function(value), left unchanged when it returns None."""
+        redis_key = self._key(key)
+
+        def transaction(pipe):
+            # called again when another client changed the key meanwhile
+            value = pipe.get(redis_key)
+            value = function(None if value is None else json.loads(value))
+            if value is not None:
+                pipe.multi()
+                pipe.set(redis_key, json.dumps(value), ex=self._expiry(ttl))
+
+        try:
+            self._client.transaction(transaction, redis_key)
+        except self._errors as e:
+            logging.warning(f'Redis update of {self.name} failed: {e!r}')
+
+    async def aget(self, key, default=None):
+        return await run_in_threadpool(self.get, key, default)
+
+    async def aset(self, key, value, ttl=None):
+        await run_in_threadpool(self.set, key, value, ttl)
+
+    async def adelete(self, key):
+        await run_in_threadpool(self.delete, key)
+
+
+def create_cache(namespace, maxsize=1024, ttl=None):
+    """Create a cache in Redis when REDIS_URL is set, otherwise in process memory."""
+    if REDIS_URL:
+        return RedisCache(REDIS_URL, namespace, ttl=ttl)
+    return LRUCache(maxsize, ttl=ttl, name=namespace)
+
+
+chat_owner_cache = create_cache('chat_owners', CHAT_OWNER_CACHE_SIZE, ttl=CHAT_OWNER_CACHE_TTL)
+
+
+def get_chat_owner(chat_id):
+    """
+    Return the google_user_id owning the chat, or None if the chat does not exist
+    or has no owner. Owners of recently used chats are answered from memory without
+    a Firestore read.
+    """
+    chat_owner = chat_owner_cache.get(chat_id)
+    if chat_owner is None:
+        with firestore_call('chats', 'get'):
+            chat_doc = db.collection('chats').document(chat_id).get()
+        if not chat_doc.exists:
+            return None
+        chat_owner = chat_doc.to_dict().get('google_user_id')
+        if chat_owner is None:
+            return None
+        chat_owner_cache.set(chat_id, chat_owner)
+    return chat_owner
+
+
+class TokenizerRegistry:
+    """
+    Process wide cache of the tokenizers used for cost accounting.
+
+    Tokenizers are keyed by the company of the model in model_company_mapping
+    (and by model name for OpenAI, whose encodings differ per model), and are
+    loaded once, either lazily on first use or eagerly through preload().
+    """
+
+    def __init__(self, model_mapping):
+        self._model_mapping = model_mapping
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def key(self, model_name):
+        """Return the key of the tokenizer used for the model."""
+        company = self._model_mapping[model_name]['company']
+        if company == 'OpenAI':
+            return (company, model_name)
+        return (company,)
+
+    def _load(self, model_name):
+        company = self._model_mapping[model_name]['company']
+
+        import tiktoken
+
+        if company == 'OpenAI':
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode_ordinary(text))
+
+        if company == 'Anthropic':
+            # Older SDKs ship the Claude tokenizer locally, newer ones only
+            # offer a network call, so approximate with cl100k in that case.
+            from anthropic import Anthropic
+
+            get_tokenizer = getattr(Anthropic(), 'get_tokenizer', None)
+            if get_tokenizer is not None:
+                tokenizer = get_tokenizer()
+                return lambda text: len(tokenizer.encode(text).ids)
+            logging.info("Local Anthropic tokenizer unavailable, using cl100k_base estimate")
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode_ordinary(text))
+
+        if company == 'Google':
+            from vertexai.preview import tokenization
+
+            tokenizer = tokenization.get_tokenizer_for_model("gemini-1.5-flash-001")
+            return lambda text: tokenizer.count_tokens(text).total_tokens
+
+        # Mistral, Perplexity and Meta models are counted with the gpt-3.5-turbo encoding
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        return lambda text: len(encoding.encode_ordinary(text))
+
+    def get(self, model_name):
+        """Return the token counting function for the model, loading it on first use."""
+        key = self.key(model_name)
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.get(key)
+                if counter is None:
+                    counter = self._load(model_name)
+                    self._counters[key] = counter
+        return counter
+
+    def count_tokens(self, model_name, text):
+        """Count the tokens of text with the tokenizer of the model."""
+        if not text:
+            return 0
+        return self.get(model_name)(text)
+
+    def preload(self):
+        """Load the tokenizer of every model in the mapping."""
+        for model_name in self._model_mapping:
+            try:
+                self.get(model_name)
+            except Exception as e:
+                logging.error(f'Error loading tokenizer for {model_name}: {e}')
+
+
+tokenizer_registry = TokenizerRegistry(model_company_mapping)
+
+
+def token_cost(input_token_length, output_token_length, model_name):
+    """
+    Calculate the cost of the chat from already counted input and output tokens.
+    """
+    chat_config = model_company_mapping.get(model_name)
+    input_cost = input_token_length * chat_config['input_token_cost_per_million'] / 1000000
+    output_cost = output_token_length * chat_config['output_token_cost_per_million'] / 1000000
+    return input_cost + output_cost
+
+
+def calculate_cost(input_string, output_string, model_name):
+    """
+    Calculate the cost of the chat based on the input and output token lengths.
+    """
+    input_token_length = tokenizer_registry.count_tokens(model_name, input_string)
+    output_token_length = tokenizer_registry.count_tokens(model_name, output_string)
+    return input_token_length, output_token_length, token_cost(input_token_length, output_token_length, model_name)
+
+
+def json_string(value):
+    """Encode a string as a JSON string literal, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # lone surrogates, which json escapes instead of rejecting
+            pass
+    return json.dumps(value)
+
+
+class SSEFrameEncoder:
+    """
+    Writes ChatEventStreaming SSE frames from a precomputed template.
+
+    The frames carry the same JSON as the ChatEventStreaming model, without building
+    a Pydantic object and running jsonable_encoder for every token.
+    """
+
+    def __init__(self, event="stream"):
+        self._prefix = 'data: {"event": ' + json_string(event) + ', "data": '
+
+    def frame(self, data="", is_final=False, chat_id=None, output_tokens=None, model=None):
+        """Return the SSE frame of a chat event, tagged with the model on compared streams."""
+        model_field = "" if model is None else f', "model": {json_string(model)}'
+        return (
+            f'{self._prefix}{json_string(data)}, "is_final": {"true" if is_final else "false"}, '
+            f'"chat_id": {"null" if chat_id is None else json_string(chat_id)}, '
+            f'"output_tokens": {"null" if output_tokens is None else int(output_tokens)}{model_field}}}\n\n'
+        )
+
+
+sse_encoder = SSEFrameEncoder()
+# frames of the streams that end in an error, and of the answers that failed in a comparison
+error_encoder = SSEFrameEncoder(event="error")
+
+
+async def coalesce_stream(source, window):
+    """
+    Group the items of an async iterator into lists of the items that arrive
+    within window seconds of the first one. The pending read is not cancelled
+    when a window closes, so the source stream is never interrupted mid-token.
+    window is a number of seconds or a function returning it for each group.
+    While the window is 0 the items are read inline, one group each, without
+    the task and wait a timed group takes.
+    """
+    if not callable(window):
+        if window <= 0:
+            async for item in source:
+                yield [item]
+            return
+        window = functools.partial(float, window)
+    iterator = source.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending = None
+    try:
+        while True:
+            try:
+                if pending is None:
+                    batch = [await iterator.__anext__()]
+                else:
+                    batch = [await pending]
+                    pending = None
+            except StopAsyncIteration:
+                return
+            seconds = window()
+            if seconds <= 0:
+                yield batch
+                continue
+            deadline = loop.time() + seconds
+            pending = asyncio.ensure_future(iterator.__anext__())
+            while True:
+                done, _ = await asyncio.wait({pending}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    break
+                try:
+                    batch.append(pending.result())
+                except StopAsyncIteration:
+                    yield batch
+                    return
+                pending = asyncio.ensure_future(iterator.__anext__())
+            yield batch
+    finally:
+        # the consumer stopped early, do not leave the read running
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+
+# Tasks that have to outlive the request that started them
+detached_tasks = set()
+
+
+def run_detached(coroutine):
+    """Run a coroutine in its own task, unaffected by the cancellation of the caller."""
+    task = asyncio.ensure_future(coroutine)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
+
+
+async def close_stream(stream):
+    """Close an async generator stream, stopping the provider request behind it."""
+    try:
+        await stream.aclose()
+    except RuntimeError:
+        # a read of the stream is still unwinding from its cancellation, it closes the stream itself
+        pass
+
+
+class StreamBackpressure:
+    """
+    Sizes the coalescing window of a stream from how fast its client reads.
+
+    The time a yielded frame takes to be sent is the write latency of the
+    connection, it grows once the client stops draining the socket. Tokens are
+    then held back for a multiple of that latency, so slow clients get fewer and
+    larger frames while fast clients keep getting every token as it arrives.
+    """
+
+    # Write latency below this is treated as a client keeping up
+    FAST_WRITE = 0.001
+    # Hold tokens for this many write latencies
+    LATENCY_FACTOR = 2
+    SMOOTHING = 0.3
+
+    def __init__(self, min_window=0.0, max_window=0.25):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.write_latency = 0.0
+        self.frames = 0
+
+    def record_write(self, seconds):
+        """Account for the time one frame took to be sent."""
+        self.frames += 1
+        self.write_latency += self.SMOOTHING * (seconds - self.write_latency)
+
+    def window(self):
+        """Seconds to coalesce the next tokens for."""
+        if self.write_latency < self.FAST_WRITE:
+            return self.min_window
+        return min(max(self.write_latency * self.LATENCY_FACTOR, self.min_window), self.max_window)
+
+
+class StreamingTokenCounter:
+    """
+    Count the output tokens of a streamed response as its chunks arrive.
+
+    Usage metadata reported by the provider on the chunks is preferred. Otherwise
+    the text is encoded incrementally, cut at whitespace so that the counts match
+    encoding the whole response at once.
+    """
+
+    # Flush text without whitespace (code, CJK) once it gets this long
+    MAX_PENDING_CHARS = 256
+
+    def __init__(self, model_name):
+        self._count = tokenizer_registry.get(model_name)
+        self._parts = []
+        self._pending = ""
+        self._counted = 0
+        self._usage_input_tokens = None
+        self._usage_output_tokens = None
+
+    def add(self, chunk):
+        """Account for a message chunk and return its text."""
+        usage = getattr(chunk, 'usage_metadata', None)
+        if usage:
+            # Chunk usage is reported as deltas that add up to the totals
+            self._usage_input_tokens = (self._usage_input_tokens or 0) + usage.get('input_tokens', 0)
+            self._usage_output_tokens = (self._usage_output_tokens or 0) + usage.get('output_tokens', 0)
+
+        text = chunk.content
+        if not isinstance(text, str):
+            text = "".join(block if isinstance(block, str) else block.get('text', '') for block in text)
+        if text:
+            self._parts.append(text)
+            self._pending += text
+            boundary = self._pending.rfind(' ')
+            if boundary > 0:
+                self._counted += self._count(self._pending[:boundary])
+                self._pending = self._pending[boundary:]
+            elif len(self._pending) > self.MAX_PENDING_CHARS:
+                self._counted += self._count(self._pending)
+                self._pending = ""
+        return text
+
+    @property
+    def text(self):
+        """The full response text received so far."""
+        return "".join(self._parts)
+
+    @property
+    def input_tokens(self):
+        """Input tokens reported by the provider, or None if it sent no usage."""
+        return self._usage_input_tokens or None
+
+    @property
+    def output_tokens(self):
+        """Output tokens received so far."""
+        if self._usage_output_tokens:
+            return self._usage_output_tokens
+        if self._pending:
+            return self._counted + self._count(self._pending)
+        return self._counted
+
+
+class HistoryTokenCache:
+    """
+    Token counts of the chat history turns that were already accounted for.
+
+    Entries are keyed by chat_id plus a hash of the turn content and the tokenizer,
+    so each turn is tokenized once over the life of a chat and only the new
+    user input has to be counted. With HISTORY_TOKEN_CACHE_PERSIST the counts are
+    also stored in the token_counts map of the chats document.
+    """
+
+    def __init__(self, maxsize, persist=False):
+        self.persist = persist
+        self._counts = LRUCache(maxsize)
+        self._loaded_chats = LRUCache(maxsize)
+
+    @staticmethod
+    def digest(model_name, user_message, ai_message):
+        """Hash identifying a turn as counted by the tokenizer of the model."""
+        content = "\0".join((repr(tokenizer_registry.key(model_name)), user_message, ai_message))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def turn_text(user_message, ai_message):
+        """The text of a turn as it appears in the formatted prompt."""
+        return f"Human: {user_message}\nAI: {ai_message}\n"
+
+    def count_turn(self, model_name, user_message, ai_message):
+        """Tokenize a turn and return its (digest, token count)."""
+        digest = self.digest(model_name, user_message, ai_message)
+        return digest, tokenizer_registry.count_tokens(model_name, self.turn_text(user_message, ai_message))
+
+    def remember(self, chat_id, digest, token_count):
+        """Store the token count of a turn of the chat."""
+        self._counts.set((chat_id, digest), token_count)
+
+    def turn_tokens(self, chat_id, model_name, user_message, ai_message):
+        """Return the token count of a turn, tokenizing it only on a cache miss."""
+        digest = self.digest(model_name, user_message, ai_message)
+        token_count = self._counts.get((chat_id, digest))
+        if token_count is None:
+            token_count = tokenizer_registry.count_tokens(model_name, self.turn_text(user_message, ai_message))
+            self.remember(chat_id, digest, token_count)
+        return token_count
+
+    def load(self, chat_id):
+        """Load the persisted token counts of a chat once per process."""
+        if not self.persist or not chat_id or self._loaded_chats.get(chat_id):
+            return
+        self._loaded_chats.set(chat_id, True)
+        try:
+            with firestore_call('chats', 'get'):
+                chat_doc = db.collection('chats').document(chat_id).get(field_paths=['token_counts'])
+            for digest, token_count in ((chat_doc.to_dict() or {}).get('token_counts') or {}).items():
+                self.remember(chat_id, digest, token_count)
+        except Exception as e:
+            logging.error(f'Error loading token counts for chat {chat_id}: {e}')
+
+
+history_token_cache = HistoryTokenCache(HISTORY_TOKEN_CACHE_SIZE, persist=HISTORY_TOKEN_CACHE_PERSIST)
+
+
+def count_input_tokens(model_name, chat_id, chat_history, user_input):
+    """
+    Count the input tokens of a chat turn, reusing the cached counts of the history.
+    """
+    if chat_history:
+        history_token_cache.load(chat_id)
+    input_token_length = sum(
+        history_token_cache.turn_tokens(chat_id, model_name, turn.user_message, turn.ai_message)
+        for turn in chat_history
+    )
+    return input_token_length + tokenizer_registry.count_tokens(model_name, f"Human: {user_input}")
+
+
+class HistoryCompactor:
+    """
+    Fits the chat history sent to the model into a token budget.
+
+    The newest turns are kept until the budget is spent, counted with the cached
+    turn token counts so older turns are never tokenized. The budget is the model's
+    context window less the room reserved for the answer and the user input, capped
+    at max_tokens to bound the input cost of long chats. With summaries enabled the
+    dropped turns are replaced by a rolling summary, extended in the background
+    as more turns fall out of the budget.
+    """
+
+    SUMMARY_MODEL = "gpt-4o-mini"
+    SUMMARY_TOKENS = 400
+    SUMMARY_REQUEST = "Summarize our conversation so far."
+    SUMMARY_INSTRUCTION = "Summarize the conversation above in at most 200 words. Keep the names, numbers, decisions and open questions."
+
+    def __init__(self, max_tokens, output_reserve, summaries, cache):
+        self.max_tokens = max_tokens
+        self.output_reserve = output_reserve
+        self.summaries = summaries
+        self._cache = cache
+        self._summarizing = set()
+
+    def budget(self, model_name, input_tokens):
+        """Tokens of history that can be sent to the model with the given input."""
+        budget = self.max_tokens
+        context_window = model_company_mapping[model_name].get('context_window')
+        if context_window:
+            budget = min(budget, context_window - min(self.output_reserve, context_window // 4) - input_tokens)
+        if self.summaries:
+            budget -= self.SUMMARY_TOKENS
+        return max(budget, 0)
+
+    def split(self, model_name, chat_id, chat_history, user_input):
+        """Return the (dropped, kept) turns of the history, the kept ones fitting the budget."""
+        if not chat_history:
+            return [], []
+        history_token_cache.load(chat_id)
+        remaining = self.budget(model_name, tokenizer_registry.count_tokens(model_name, f"Human: {user_input}"))
+        start = len(chat_history)
+        while start > 0:
+            turn = chat_history[start - 1]
+            turn_tokens = history_token_cache.turn_tokens(chat_id, model_name, turn.user_message, turn.ai_message)
+            if turn_tokens > remaining:
+                break
+            remaining -= turn_tokens
+            start -= 1
+        return chat_history[:start], chat_history[start:]
+
+    async def compact(self, model_name, chat_id, chat_history, user_input):
+        """Return the history to send to the model for the next turn."""
+        dropped, kept = await run_in_threadpool(self.split, model_name, chat_id, chat_history, user_input)
+        if not dropped:
+            return kept
+        logging.info(f'Sending {len(kept)} of {len(chat_history)} turns of chat {chat_id} to {model_name}')
+        if not self.summaries or not chat_id:
+            return kept
+        entry = await run_in_threadpool(self._cache.get, chat_id)
+        digests = [self._digest(turn) for turn in chat_history]
+        covered = digests.index(entry['last_turn']) + 1 if entry and entry['last_turn'] in digests else 0
+        if covered > len(dropped):
+            # the summary covers turns that are still sent, as after a regenerated message
+            return kept
+        if covered < len(dropped) and chat_id not in self._summarizing:
+            self._summarizing.add(chat_id)
+            run_detached(self._summarize(chat_id, dropped[covered:], entry))
+        if entry is None:
+            return kept
+        # a summary that is behind by a few turns still beats none, it is extended meanwhile
+        return [ChatHistory(user_message=self.SUMMARY_REQUEST, ai_message=entry['summary'])] + kept
+
+    @staticmethod
+    def _digest(turn):
+        return hashlib.sha1(f"{turn.user_message}\0{turn.ai_message}".encode('utf-8')).hexdigest()
+
+    async def _summarize(self, chat_id, new_turns, entry):
+        """Extend the summary of the chat with the turns dropped since it was written."""
+        try:
+            last_turn = self._digest(new_turns[-1])
+            # the summary model gets the newest of the turns that fit its own budget
+            _, new_turns = await run_in_threadpool(self.split, self.SUMMARY_MODEL, chat_id, new_turns, self.SUMMARY_INSTRUCTION)
+            history_messages = []
+            if entry:
+                history_messages.append(HumanMessage(content=self.SUMMARY_REQUEST))
+                history_messages.append(AIMessage(content=entry['summary']))
+            for turn in new_turns:
+                history_messages.append(HumanMessage(content=turn.user_message))
+                history_messages.append(AIMessage(content=turn.ai_message))
+            prompt = ChatPromptTemplate(
+                messages=[
+                    MessagesPlaceholder(variable_name="chat_history"),
+                    HumanMessagePromptTemplate.from_template("{user_input}"),
+                ]
+            )
+            chain = prompt | llm_client_pool.get(self.SUMMARY_MODEL, 0.2) | StrOutputParser()
+            summary = await chain.ainvoke({"chat_history": history_messages, "user_input": self.SUMMARY_INSTRUCTION})
+            await run_in_threadpool(self._cache.set, chat_id, {'last_turn': last_turn, 'summary': summary})
+        except Exception as e:
+            logging.error(f'Error summarizing chat {chat_id}: {e}')
+        finally:
+            self._summarizing.discard(chat_id)
+
+
+history_compactor = HistoryCompactor(
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_OUTPUT_RESERVE,
+    HISTORY_SUMMARY,
+    create_cache('history_summaries', HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL),
+)
+
+
+class ConversationHistoryStore:
+    """
+    Server side history of the chats, so clients can send only chat_id and user_input.
+
+    Turns are served from a hot cache, loaded from the chat_history collection on a
+    miss, and appended write-through when a turn is saved. Regenerated turns replace
+    the turn they regenerate, the same way the web client rebuilds a chat.
+    """
+
+    def __init__(self, cache, max_turns):
+        self.max_turns = max_turns
+        self._cache = cache
+
+    @staticmethod
+    def _add_turn(turns, turn):
+        if turn.get('regenerate_message') and turns:
+            turns.pop()
+        turns.append({'user_message': turn['user_message'], 'ai_message': turn['ai_message']})
+
+    def _trim(self, turns):
+        # one extra turn is kept so that a regenerated message can drop the last one
+        return turns[-(self.max_turns + 1):]
+
+    def _load(self, chat_id):
+        chat_owner = get_chat_owner(chat_id)
+        if chat_owner is None:
+            return None
+        # Read only the newest turns, with room for the regenerated ones they replace
+        history_ref = db.collection('chat_history').where(filter=FieldFilter('chat_id', '==', chat_id)) \
+            .order_by('created_at', direction=google_firestore.Query.DESCENDING) \
+            .limit(2 * (self.max_turns + 1)).stream()
+        with firestore_call('chat_history', 'query'):
+            history_docs = [history_doc.to_dict() for history_doc in history_ref]
+        turns = []
+        for turn in reversed(history_docs):
+            self._add_turn(turns, turn)
+        entry = {'google_user_id': chat_owner, 'turns': self._trim(turns)}
+        self._cache.set(chat_id, entry)
+        return entry
+
+    def chat_history(self, chat_id, google_user_id, regenerate_message=False):
+        """Return the history of the chat to send to the model for the next turn."""
+        entry = self._cache.get(chat_id)
+        if entry is None:
+            entry = self._load(chat_id)
+            if entry is None:
+                return []
+        if entry['google_user_id'] != google_user_id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Forbidden",
+            )
+        turns = entry['turns']
+        # A regenerated message replaces the last turn, so it is not part of the history
+        if regenerate_message and turns:
+            turns = turns[:-1]
+        return [ChatHistory(**turn) for turn in turns[-self.max_turns:]]
+
+    def append(self, chat_id, google_user_id, turn, new_chat=False):
+        """Write a new turn of the chat through to the cache."""
+
+        def add(entry):
+            if new_chat:
+                entry = {'google_user_id': google_user_id, 'turns': []}
+            if entry is None:
+                # not cached, the next read loads it from the chat_history collection
+                return None
+            self._add_turn(entry['turns'], turn)
+            entry['turns'] = self._trim(entry['turns'])
+            return entry
+
+        try:
+            # atomic, the workers may append turns of the chat at the same time
+            self._cache.update(chat_id, add)
+        except Exception as e:
+            logging.error(f'Error caching chat history for chat {chat_id}: {e}')
+
+
+conversation_history_store = ConversationHistoryStore(
+    create_cache('chat_history', HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL),
+    SERVER_HISTORY_MAX_TURNS,
+)
+
+
+async def resolve_chat_history(request, token_info):
+    """Load the chat history on the server when the client did not send it."""
+    if request.chat_history is not None:
+        return request.chat_history
+    if not request.chat_id:
+        return []
+    return await run_in_threadpool(conversation_history_store.chat_history, request.chat_id, token_info['sub'], request.regenerate_message)
+
+
+class ResponseCache:
+    """
+    Responses to identical prompts, keyed by model, temperature and the normalized
+    chat history and input, so canned questions are not generated and billed again.
+
+    Only prompts at or below max_temperature are cached, above it a new answer is
+    expected every time. Each entry keeps the cost of its generation to report the
+    dollars saved by the hits.
+    """
+
+    def __init__(self, cache, enabled, max_temperature):
+        self.enabled = enabled
+        self.max_temperature = max_temperature
+        self._cache = cache
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.saved_cost = 0.0
+
+    @staticmethod
+    def _normalize(text):
+        return " ".join(text.split())
+
+    def key(self, model_name, temperature, chat_history, user_input):
+        """Return the cache key of a prompt, or None when it is not cacheable."""
+        if not self.enabled or temperature > self.max_temperature:
+            return None
+        prompt = [model_name, round(temperature, 2), self._normalize(user_input)]
+        prompt.extend((self._normalize(turn.user_message), self._normalize(turn.ai_message)) for turn in chat_history)
+        return hashlib.sha256(json.dumps(prompt).encode('utf-8')).hexdigest()
+
+    async def get(self, key):
+        """Return the cached response of the key and account for the lookup."""
+        if key is None:
+            return None
+        entry = await self._cache.aget(key)
+        with self._lock:
+            self.lookups += 1
+            if entry is not None:
+                self.hits += 1
+                self.saved_cost += entry['cost']
+        return entry
+
+    async def set(self, key, text, cost, input_tokens=None, output_tokens=None):
+        """Cache a generated response with the cost it took to generate."""
+        if key is None or not text:
+            return
+        await self._cache.aset(key, {
+            'text': text,
+            'cost': cost,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+        })
+
+    @staticmethod
+    async def replay(entry):
+        """Stream a cached response in word sized chunks, the way a provider streams it."""
+        for piece in re.findall(r'\s*\S+|\s+', entry['text']):
+            yield AIMessageChunk(content=piece)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'saved_cost': self.saved_cost,
+            }
+
+
+response_cache = ResponseCache(
+    create_cache('responses', RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL),
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_MAX_TEMPERATURE,
+)
+
+
+@app.on_event("startup")
+async def preload_tokenizers():
+    """Load the tokenizers up front when TOKENIZER_PRELOAD is enabled."""
+    if TOKENIZER_PRELOAD:
+        await run_in_threadpool(tokenizer_registry.preload)
+
+
+class LLMClientPool:
+    """
+    Reusable chat model instances keyed by (model, temperature bucket).
+
+    Reusing the instances keeps the connection pools of the provider SDKs alive.
+    Providers whose model class accepts http_client / http_async_client also share
+    one keep-alive (HTTP/2 when available) httpx client pair per provider, which is
+    instrumented to report how many connections and TLS handshakes were made.
+    """
+
+    def __init__(self, model_mapping, temperature_step=0.1):
+        self.temperature_step = temperature_step
+        self._model_mapping = model_mapping
+        self._models = {}
+        self._http_clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connections_opened = 0
+        self.handshakes = 0
+
+    def temperature_bucket(self, temperature):
+        """Round the temperature to the pool's bucket size."""
+        return round(round(temperature / self.temperature_step) * self.temperature_step, 2)
+
+    def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+        elif event_name == 'connection.start_tls.complete':
+            self.handshakes += 1
+
+    async def _async_trace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _new_http_clients(self):
+        def add_sync_trace(request):
+            request.extensions['trace'] = self._trace
+
+        async def add_async_trace(request):
+            request.extensions['trace'] = self._async_trace
+
+        limits = httpx.Limits(max_keepalive_connections=100, keepalive_expiry=60)
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        return (
+            httpx.Client(http2=http2, limits=limits, event_hooks={'request': [add_sync_trace]}),
+            httpx.AsyncClient(http2=http2, limits=limits, event_hooks={'request': [add_async_trace]}),
+        )
+
+    def _create(self, model_name, temperature):
+        model_class = resolve_model_class(model_name)
+        kwargs = {'model_name': model_name, 'model': model_name, 'temperature': temperature}
+        fields = getattr(model_class, '__fields__', {})
+        if 'http_client' in fields and 'http_async_client' in fields:
+            provider = model_class.__name__
+            if provider not in self._http_clients:
+                self._http_clients[provider] = self._new_http_clients()
+            kwargs['http_client'], kwargs['http_async_client'] = self._http_clients[provider]
+        return model_class(**kwargs)
+
+    def get(self, model_name, temperature):
+        """Return the shared chat model instance for the model and temperature."""
+        key = (model_name, self.temperature_bucket(temperature))
+        chat = self._models.get(key)
+        if chat is not None:
+            self.hits += 1
+            return chat
+        with self._lock:
+            chat = self._models.get(key)
+            if chat is None:
+                self.misses += 1
+                chat = self._create(*key)
+                self._models[key] = chat
+            else:
+                self.hits += 1
+        return chat
+
+    def open_connections(self):
+        """Number of connections currently held by the shared httpx clients."""
+        count = 0
+        for clients in self._http_clients.values():
+            for client in clients:
+                pool = getattr(getattr(client, '_transport', None), '_pool', None)
+                count += len(getattr(pool, 'connections', []))
+        return count
+
+    def stats(self):
+        """Pool usage statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'models': len(self._models),
+            'shared_http_clients': len(self._http_clients),
+            'open_connections': self.open_connections(),
+            'connections_opened': self.connections_opened,
+            'handshakes': self.handshakes,
+        }
+
+    async def aclose(self):
+        """Close the shared httpx clients."""
+        for sync_client, async_client in self._http_clients.values():
+            sync_client.close()
+            await async_client.aclose()
+        self._http_clients.clear()
+        self._models.clear()
+
+
+llm_client_pool = LLMClientPool(model_company_mapping)
+
+
+class ProviderHealth:
+    """
+    Circuit breaker and time to first token EWMA of a provider.
+
+    The circuit opens after failure_threshold consecutive failures. Once
+    reset_timeout has passed one request is let through, and its outcome
+    closes the circuit or opens it again.
+    """
+
+    SMOOTHING = 0.2
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.ttft = None
+        self._probing = False
+
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Whether a request may be sent to the provider now."""
+        state = self.state()
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self, ttft):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self.ttft = ttft if self.ttft is None else self.ttft + self.SMOOTHING * (ttft - self.ttft)
+
+    def record_cancelled(self):
+        """A request that was cancelled tells nothing about the provider."""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class RoutedStream:
+    """
+    Message chunk stream of a chat prompt, served by the requested model or a backup.
+
+    model_name is the model that serves the stream once the first chunk is out.
+    """
+
+    def __init__(self, router, model_name, temperature, prompt, inputs, parent=None):
+        self.model_name = model_name
+        self._stream = router._stream(self, model_name, temperature, prompt, inputs, parent)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._stream.__anext__()
+
+    def aclose(self):
+        return self._stream.aclose()
+
+
+class ProviderRouter:
+    """
+    Routes chat streams to the providers of model_company_mapping.
+
+    A model whose provider fails before the first token, or whose circuit is
+    open, falls back to a backup model of the same tier: same premium flag, an
+    other provider with a closed circuit and at least the same context window,
+    the closest in price first. With hedge_after set, a backup is also started
+    when the first token takes longer than that, and whichever model answers
+    first serves the stream while the other request is cancelled.
+    """
+
+    def __init__(self, model_mapping, hedge_after, fallback, failure_threshold, reset_timeout):
+        self.hedge_after = hedge_after
+        self.fallback = fallback
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._model_mapping = model_mapping
+        self._health = {}
+        self.hedges = 0
+        self.fallbacks = 0
+
+    def health(self, model_name):
+        """Health of the provider of the model."""
+        provider = model_provider(self._model_mapping[model_name])
+        if provider not in self._health:
+            self._health[provider] = ProviderHealth(self.failure_threshold, self.reset_timeout)
+        return self._health[provider]
+
+    @staticmethod
+    def _price(chat_config):
+        return chat_config['input_token_cost_per_million'] + chat_config['output_token_cost_per_million']
+
+    def backups(self, model_name):
+        """Equivalent models of other providers, best candidates first."""
+        chat_config = self._model_mapping[model_name]
+        provider = model_provider(chat_config)
+        candidates = []
+        for backup_name, backup_config in self._model_mapping.items():
+            if model_provider(backup_config) == provider or backup_config['premium'] != chat_config['premium']:
+                continue
+            if (backup_config.get('context_window') or 0) < (chat_config.get('context_window') or 0):
+                continue
+            if self.health(backup_name).state() == 'open':
+                continue
+            price_distance = abs(math.log((self._price(backup_config) or 1e-9) / (self._price(chat_config) or 1e-9)))
+            candidates.append((price_distance, self.health(backup_name).ttft or 0, backup_name))
+        return [backup_name for _, _, backup_name in sorted(candidates)]
+
+    def stream(self, model_name, temperature, prompt, inputs, parent=None):
+        """Return a RoutedStream of the prompt's message chunks, its requests traced under parent."""
+        return RoutedStream(self, model_name, temperature, prompt, inputs, parent)
+
+    async def _first_chunk(self, model_name, stream, parent):
+        started_at = time.perf_counter()
+        try:
+            with tracer.span("provider_first_token", parent=parent, model=model_name, company=self._model_mapping[model_name]['company']):
+                chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            chunk = None
+        except asyncio.CancelledError:
+            self.health(model_name).record_cancelled()
+            raise
+        except Exception:
+            self.health(model_name).record_failure()
+            raise
+        self.health(model_name).record_success(time.perf_counter() - started_at)
+        return chunk
+
+    async def _stream(self, routed, model_name, temperature, prompt, inputs, parent):
+        backups = iter(self.backups(model_name) if self.fallback or self.hedge_after else [])
+        attempts = {}
+
+        def start(attempt_model, ticket=None):
+            stream = (prompt | llm_client_pool.get(attempt_model, temperature)).astream(inputs)
+            task = asyncio.ensure_future(self._first_chunk(attempt_model, stream, parent))
+            attempts[task] = (attempt_model, stream, ticket)
+
+        def start_backup():
+            for backup_name in backups:
+                if self.health(backup_name).allow():
+                    # the request holds a slot of its own provider only, a backup needs one of its provider
+                    ticket = admission_controller.try_admit(model_provider(self._model_mapping[backup_name]))
+                    if ticket is None:
+                        self.health(backup_name).record_cancelled()
+                        continue
+                    start(backup_name, ticket)
+                    return True
+            return False
+
+        if self.health(model_name).allow() or not (self.fallback and start_backup()):
+            start(model_name)
+        winner = None
+        error = None
+        hedged = False
+        try:
+            while attempts and winner is None:
+                timeout = self.hedge_after if self.hedge_after and not hedged else None
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # slow first token, race a backup against it
+                    hedged = True
+                    if start_backup():
+                        self.hedges += 1
+                        logging.info(f'Hedging {model_name} after {self.hedge_after}s')
+                    continue
+                for task in done:
+                    attempt_model, stream, ticket = attempts.pop(task)
+                    if task.exception() is None:
+                        if winner is None:
+                            winner = (attempt_model, stream, task.result(), ticket)
+                        else:
+                            run_detached(close_stream(stream))
+                            if ticket is not None:
+                                ticket.release()
+                        continue
+                    if ticket is not None:
+                        ticket.release()
+                    error = task.exception()
+                    logging.warning(f'{attempt_model} failed before its first token: {error!r}')
+                    if self.fallback and winner is None and not attempts and start_backup():
+                        self.fallbacks += 1
+        finally:
+            # cancel the requests that lost the race, or all of them when the stream is closed
+            for task, (_, stream, ticket) in attempts.items():
+                task.cancel()
+                if ticket is not None:
+                    ticket.release()
+        if winner is None:
+            raise error or RuntimeError(f'No provider available for {model_name}')
+
+        routed.model_name, stream, first_chunk, ticket = winner
+        try:
+            if first_chunk is None:
+                return
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+        except Exception:
+            self.health(routed.model_name).record_failure()
+            raise
+        finally:
+            await close_stream(stream)
+            if ticket is not None:
+                ticket.release()
+
+    def stats(self):
+        """Routing counters and the health of every provider used so far."""
+        return {
+            'hedges': self.hedges,
+            'fallbacks': self.fallbacks,
+            'providers': {
+                provider: {'state': health.state(), 'failures': health.failures, 'ttft_ewma': health.ttft}
+                for provider, health in self._health.items()
+            },
+        }
+
+
+provider_router = ProviderRouter(
+    model_company_mapping,
+    HEDGE_TTFT_SECONDS,
+    PROVIDER_FALLBACK,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_SECONDS,
+)
+
+
+class ProviderSlots:
+    """
+    Concurrent stream slots of one provider, and the requests waiting for one.
+
+    Waiters are kept in a heap ordered by (priority, arrival), a released slot is
+    handed over to the first waiter still waiting. Waiters that gave up stay in
+    the heap until they are popped.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        # moving average of the seconds a slot is held, for the Retry-After estimate
+        self.hold = 10.0
+        self._waiters = []
+        self._arrivals = itertools.count()
+
+    def try_acquire(self):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return True
+        return False
+
+    def enqueue(self, priority):
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), waiter))
+        self.waiting += 1
+        return waiter
+
+    def abandon(self, waiter):
+        """Remove a waiter that stopped waiting, returns False when it was given a slot meanwhile."""
+        if waiter.done() and not waiter.cancelled():
+            return False
+        waiter.cancel()
+        self.waiting -= 1
+        return True
+
+    def release(self, held):
+        self.hold = 0.8 * self.hold + 0.2 * held
+        while self._waiters:
+            _priority, _arrival, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # the slot goes to the waiter, active is unchanged
+                self.waiting -= 1
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self):
+        """Seconds until a slot is likely to be free for a new request."""
+        return min(60, max(1, math.ceil(self.hold * (self.waiting + 1) / self.limit)))
+
+
+class AdmissionTicket:
+    """A chat request let through by the AdmissionController, released once when its stream ends."""
+
+    def __init__(self, controller, google_user_id, provider, user_slot):
+        self._controller = controller
+        self.google_user_id = google_user_id
+        self.provider = provider
+        self.user_slot = user_slot
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._controller.release(self)
+
+
+class AdmissionController:
+    """
+    Bounds the chat streams sent to each provider, as named by model_provider,
+    and the streams of each user.
+
+    A request over its provider's limit waits in line, users with a payment in
+    the payments collection ahead of the others. Requests of users already at
+    their limit, requests finding the line full and requests still waiting
+    after max_wait seconds are refused with a 429 and a Retry-After estimate.
+
+    Slots are counted per worker process.
+    """
+
+    def __init__(self, limits, default_limit, per_user, max_queue, max_wait, paying_users):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        # google_user_id -> whether the user has paid, shared by the workers with REDIS_URL
+        self.paying_users = paying_users
+        self._slots = {}
+        self._in_flight = collections.Counter()
+
+    @staticmethod
+    def parse_limits(spec, providers):
+        """Parse "Together=8,Perplexity=4" into {provider: limit}, raising ValueError on a provider not in providers."""
+        limits = {}
+        for item in spec.split(","):
+            if item.strip():
+                provider, limit = item.split("=", 1)
+                provider = provider.strip()
+                if provider not in providers:
+                    raise ValueError(f"Unknown provider {provider!r} in PROVIDER_CONCURRENCY, expected one of {', '.join(sorted(providers))}")
+                limits[provider] = int(limit)
+        return limits
+
+    def slots(self, provider):
+        if provider not in self._slots:
+            self._slots[provider] = ProviderSlots(self.limits.get(provider, self.default_limit))
+        return self._slots[provider]
+
+    def try_admit(self, provider):
+        """
+        Take a free slot of the provider without waiting, or return None. For the
+        backups started by the ProviderRouter, whose request is already admitted.
+        """
+        slots = self.slots(provider)
+        if not slots.try_acquire():
+            admission_rejected_total.inc(provider, "backup_full")
+            return None
+        admission_in_flight.inc(provider)
+        return AdmissionTicket(self, None, provider, user_slot=False)
+
+    def is_paying(self, google_user_id):
+        """Whether the user made a payment, read from the payments collection once per cache lifetime."""
+        paying = self.paying_users.get(google_user_id)
+        if paying is None:
+            payments = db.collection('payments').where(filter=FieldFilter('customer_id', '==', google_user_id)).limit(1)
+            with firestore_call('payments', 'query'):
+                paying = any(True for _ in payments.stream())
+            self.paying_users.set(google_user_id, paying)
+        return paying
+
+    async def admit(self, google_user_id, provider, user_slot=True):
+        """
+        Wait for a slot of the provider and return the AdmissionTicket.
+        provider is None for requests that do not call a provider, they only count for the user's limit.
+        Without user_slot the stream does not count for the user's limit, as the
+        streams of a comparison after the first.
+        """
+        slots = self.slots(provider) if provider is not None else None
+        if user_slot:
+            if self._in_flight[google_user_id] >= self.per_user:
+                self._reject(provider, "user_limit", "Too many chats in progress", slots.retry_after() if slots else 1)
+            self._in_flight[google_user_id] += 1
+        ticket = AdmissionTicket(self, google_user_id, provider, user_slot)
+        if slots is None or slots.try_acquire():
+            if slots is not None:
+                admission_in_flight.inc(provider)
+                admission_wait_seconds.observe(0, provider, "immediate")
+            return ticket
+
+        try:
+            if slots.waiting >= self.max_queue:
+                self._reject(provider, "queue_full", f"{provider} is overloaded", slots.retry_after())
+            paying = await run_in_threadpool(self.is_paying, google_user_id)
+            tier = "paying" if paying else "free"
+            # a slot may have been freed during the lookup
+            if not slots.try_acquire():
+                waiter = slots.enqueue(0 if paying else 1)
+                admission_queue_depth.inc(provider)
+                try:
+                    async with asyncio.timeout(self.max_wait):
+                        await waiter
+                except TimeoutError:
+                    if slots.abandon(waiter):
+                        self._reject(provider, "timeout", f"{provider} is overloaded", slots.retry_after())
+                except asyncio.CancelledError:
+                    if not slots.abandon(waiter):
+                        # the slot arrived with the cancellation, pass it on
+                        slots.release(0)
+                    raise
+                finally:
+                    admission_queue_depth.dec(provider)
+        except BaseException:
+            if user_slot:
+                self._leave(google_user_id)
+            raise
+        admission_in_flight.inc(provider)
+        admission_wait_seconds.observe(time.monotonic() - ticket.admitted_at, provider, tier)
+        ticket.admitted_at = time.monotonic()
+        return ticket
+
+    @staticmethod
+    def _reject(provider, reason, detail, retry_after):
+        admission_rejected_total.inc(provider or "none", reason)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def _leave(self, google_user_id):
+        self._in_flight[google_user_id] -= 1
+        if self._in_flight[google_user_id] <= 0:
+            del self._in_flight[google_user_id]
+
+    def release(self, ticket):
+        if ticket.user_slot:
+            self._leave(ticket.google_user_id)
+        if ticket.provider is not None:
+            admission_in_flight.dec(ticket.provider)
+            self.slots(ticket.provider).release(time.monotonic() - ticket.admitted_at)
+
+    def stats(self):
+        """Slots in use and waiting requests of every provider used so far."""
+        return {
+            'users_in_flight': len(self._in_flight),
+            'providers': {
+                provider: {'limit': slots.limit, 'active': slots.active, 'waiting': slots.waiting, 'hold_ewma': slots.hold}
+                for provider, slots in self._slots.items()
+            },
+        }
+
+
+admission_controller = AdmissionController(
+    AdmissionController.parse_limits(PROVIDER_CONCURRENCY, {model_provider(chat_config) for chat_config in model_company_mapping.values()}),
+    PROVIDER_CONCURRENCY_DEFAULT,
+    USER_MAX_IN_FLIGHT,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_MAX_WAIT,
+    create_cache('paying_users', 10000, ttl=PAYING_USERS_CACHE_TTL),
+)
+
+
+@app.on_event("shutdown")
+async def flush_persistence_queue():
+    """Save the queued chat turns before the process exits."""
+    await persistence_queue.flush()
+    tracer.exporter.flush()
+
+
+@app.on_event("shutdown")
+async def close_llm_client_pool():
+    """Close the pooled provider connections."""
+    await llm_client_pool.aclose()
+
+
+@app.exception_handler(Exception)
+async def generic_exception_handler(request, exc):
+    """Generic exception handler to catch unexpected errors."""
+    logging.error("Unexpected error occurred: %s", exc)
+    return {"message": "Internal server error", "detail": str(exc)}, 500
+
+@app.exception_handler(HTTPException)
+async def custom_http_exception_handler(request, exc: HTTPException):
+    """Custom HTTP exception handler to catch HTTP exceptions."""
+    return JSONResponse(
+        status_code=exc.status_code if exc.status_code else status.HTTP_403_FORBIDDEN,
+        content={"status": exc.status_code if exc.status_code else status.HTTP_403_FORBIDDEN, "details": exc.detail},
+        headers=exc.headers,
+    )
+
+google_http_client = None
+
+# Verified Google tokens keyed by their hash, and users known to be in the users collection,
+# shared by the workers when REDIS_URL is set
+google_token_cache = create_cache('google_tokens', 10000, ttl=GOOGLE_TOKEN_CACHE_TTL)
+known_users = create_cache('known_users', 100000)
+
+
+def get_google_http_client():
+    """Return the pooled HTTP client used to call the Google APIs."""
+    global google_http_client
+    if google_http_client is None:
+        google_http_client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60))
+    return google_http_client
+
+
+async def verify_google_token(background_tasks: BackgroundTasks, credentials: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+    """Verify the Google ID token and return the user info."""
+    if credentials:
+        token = credentials.credentials
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        try:
+            user_info = await google_token_cache.aget(token_hash)
+            if user_info is None:
+                with tracer.span("google_userinfo"):
+                    request = await get_google_http_client().get(GOOGLE_USERINFO_URL, headers={"Authorization": f"Bearer {token}"})
+
+                    # Check if the request was successful
+                    request.raise_for_status()
+
+                user_info = request.json()
+                await google_token_cache.aset(token_hash, user_info)
+            
+            # Add the user to the database as a background task, once per user and cache
+            if not await known_users.aget(user_info['sub']):
+                # Check if the user is in the database using the sub field, in the collection users the sub is set to google_user_id field
+                user_ref = db.collection('users').document(user_info['sub'])
+                user_data = {
+                    'email': user_info['email'],
+                    'username': user_info['name'],
+                    'profile_picture': user_info['picture'],
+                    'google_user_id': user_info['sub'],
+                }
+                background_tasks.add_task(add_user_to_db, user_ref, user_data)
+
+            return user_info
+        except httpx.HTTPStatusError as exc:
+            if exc.response.is_client_error:
+                # Invalid token
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid or expired Google ID token",
+                    headers={"WWW-Authenticate": "Bearer"},
+                ) from exc
+            # Google failed, the token may well be valid
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="Google token verification failed",
+            ) from exc
+        except ValueError as exc:
+            # Google answered with a body that is not JSON
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="Google token verification failed",
+            ) from exc
+        except httpx.RequestError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Google token verification unavailable",
+            ) from exc
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Authorization header missing",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.on_event("shutdown")
+async def close_google_http_client():
+    """Close the pooled Google API connections."""
+    if google_http_client is not None:
+        await google_http_client.aclose()
+
+
+
+class GenerationQuota:
+    """
+    Remaining generations of the users, stored in the user_generations collection.
+
+    A generation is reserved atomically in a transaction before streaming and is
+    refunded with an Increment if the generation fails, so concurrent streams of the
+    same user can neither overspend nor lose quota. The remaining count is cached
+    for a short time so the precheck usually costs no round trip.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def _ref(self, google_user_id):
+        return db.collection('user_generations').document(google_user_id)
+
+    def _new_user_data(self, google_user_id, remaining_generations):
+        return {
+            'google_user_id': google_user_id,
+            'remaining_generations': remaining_generations,
+            'created_at': google_firestore.SERVER_TIMESTAMP,
+            'updated_at': google_firestore.SERVER_TIMESTAMP,
+        }
+
+    async def cached_remaining(self, google_user_id):
+        """Return the cached remaining generations, or None when unknown."""
+        return await self._cache.aget(google_user_id)
+
+    def remaining(self, google_user_id):
+        """Return the remaining generations, creating the free quota for new users."""
+        remaining_generations = self._cache.get(google_user_id)
+        if remaining_generations is not None:
+            return remaining_generations
+        user_generations_ref = self._ref(google_user_id)
+        with firestore_call('user_generations', 'get'):
+            user_generations_data = user_generations_ref.get()
+        if user_generations_data.exists:
+            remaining_generations = user_generations_data.to_dict()['remaining_generations']
+        else:
+            # create a new document for the user with the remaining generations
+            with firestore_call('user_generations', 'set'):
+                user_generations_ref.set(self._new_user_data(google_user_id, FREE_GENERATIONS))
+            remaining_generations = FREE_GENERATIONS
+        self._cache.set(google_user_id, remaining_generations)
+        return remaining_generations
+
+    def reserve(self, google_user_id, generations=1):
+        """
+        Atomically take generations from the user, one per streamed answer.
+        Returns the generations left after the reservation, or None if there were not enough left.
+        """
+        user_generations_ref = self._ref(google_user_id)
+
+        @google_firestore.transactional
+        def reserve_in_transaction(transaction):
+            snapshot = user_generations_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                if FREE_GENERATIONS < generations:
+                    return None
+                transaction.set(user_generations_ref, self._new_user_data(google_user_id, FREE_GENERATIONS - generations))
+                return FREE_GENERATIONS - generations
+            remaining_generations = snapshot.to_dict()['remaining_generations']
+            if remaining_generations < generations:
+                return None
+            transaction.update(user_generations_ref, {
+                'remaining_generations': remaining_generations - generations,
+                'updated_at': google_firestore.SERVER_TIMESTAMP,
+            })
+            return remaining_generations - generations
+
+        with tracer.span("reserve_generation"), firestore_call('user_generations', 'transaction'):
+            remaining_generations = reserve_in_transaction(db.transaction())
+        if remaining_generations is not None:
+            self._cache.set(google_user_id, remaining_generations)
+            generations_consumed_total.inc(amount=generations)
+        elif generations == 1:
+            self._cache.set(google_user_id, 0)
+        else:
+            # fewer than requested may still be left
+            self._cache.delete(google_user_id)
+        return remaining_generations
+
+    def credit(self, google_user_id, generations):
+        """Atomically add generations to the user, used for refunds and purchases."""
+        with firestore_call('user_generations', 'update'):
+            self._ref(google_user_id).update({
+                'remaining_generations': google_firestore.Increment(generations),
+                'updated_at': google_firestore.SERVER_TIMESTAMP,
+            })
+        self._cache.delete(google_user_id)
+
+    def refund(self, google_user_id):
+        """Give back a reserved generation that was not used."""
+        try:
+            self.credit(google_user_id, 1)
+            generations_refunded_total.inc()
+        except Exception as e:
+            logging.error(f'Error refunding generation for user {google_user_id}: {e}')
+
+
+generation_quota = GenerationQuota(create_cache('user_generations', 10000, ttl=GENERATIONS_CACHE_TTL))
+
+
+def get_generations(token_info: dict = Depends(verify_google_token)):
+    """Verify the number of generations left for the user."""
+    with tracer.span("get_generations"):
+        return generation_quota.remaining(token_info['sub'])
+
+
+@app.get("/auth/google", response_model=dict, tags=["Authentication Endpoints"])
+async def google_auth(idinfo: dict = Depends(verify_google_token)):
+    """Google authentication endpoint to verify the Google ID token."""
+    # create a new JWT token using sub and the secret key with expiry time of 30 days
+    token = jwt.encode({"sub": idinfo["sub"], "exp": datetime.datetime.utcnow() + datetime.timedelta(days=30)}, SECRET_KEY, algorithm="HS256")
+    return {"accessToken": token, "user": idinfo, "token_type": "Bearer"}
+
+# Example usage within your verify_token dependency
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+    """Verify the JWT token and return the user info."""
+    if credentials:
+        token = credentials.credentials
+        try:
+            with tracer.span("verify_token"):
+                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+            return payload
+        except jwt.JWTError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid or expired token",
+            ) from exc
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Authorization header missing",
+        )
+    
+@app.get("/verify", tags=["Authentication Endpoints"])
+async def verify_token_info(token_info: dict = Depends(verify_token)):
+    """Verify the JWT token and return the user info."""
+    return {"token_info": token_info}
+
+
+@app.post("/v1/chat_event_streaming", tags=["AI Endpoints"])
+async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(verify_token)):
+    """Chat Event Streaming endpoint for the OpenAI chatbot."""
+    request_started_at = time.perf_counter()
+    try:
+        # Get the chat model from the request and create the corresponding chat instance
+        chat_model = request.chat_model
+        chat_config = model_company_mapping.get(chat_model)
+
+        if not chat_config:
+            raise ValueError(f"Invalid chat model: {chat_model}")
+        
+        # Precheck the generations left from the cache, without a round trip in the common case
+        cached_generations_left = await generation_quota.cached_remaining(token_info['sub'])
+        if cached_generations_left == 0:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Generations limit exceeded",
+            )
+
+        request.chat_history = await resolve_chat_history(request, token_info)
+
+        # The turn is saved under ids allocated up front, so the final event does not wait for Firestore
+        chat_id, new_chat = await run_in_threadpool(allocate_chat_id, request.chat_id, token_info['sub'])
+        turn_id = str(uuid.uuid4())
+        
+        # Identical prompts are answered from the response cache when it is enabled,
+        # a regenerated message asks for a new answer
+        response_key = None if request.regenerate_message else response_cache.key(chat_model, request.temperature, request.chat_history, request.user_input)
+        cached_response = await response_cache.get(response_key)
+
+        # Keep the newest turns that fit the model's context and the history budget
+        if cached_response is None:
+            request.chat_history = await history_compactor.compact(chat_model, chat_id, request.chat_history, request.user_input)
+
+        prompt = ChatPromptTemplate(
+            messages=[
+                # SystemMessagePromptTemplate.from_template(""),
+                MessagesPlaceholder(variable_name="chat_history"),
+                HumanMessagePromptTemplate.from_template("{user_input}"),
+            ]
+        )
+        # Seed the chat history with the user's input from the request
+        history_messages = []
+        for chat_history in request.chat_history:
+            history_messages.append(HumanMessage(content=chat_history.user_message))
+            history_messages.append(AIMessage(content=chat_history.ai_message))
+        
+        # Wait for a slot of the provider, a replayed response only counts for the user's limit
+        admission = await admission_controller.admit(token_info['sub'], None if cached_response is not None else model_provider(chat_config))
+        try:
+            # Stream the conversation on the event loop, the blocking tokenizer and
+            # Firestore calls are pushed to the threadpool only for their own duration
+            token_counter = await run_in_threadpool(StreamingTokenCounter, chat_model)
+            # the model that serves the turn, a backup when the router fell back or hedged
+            served_model = chat_model
+
+            # Reserve the generation before streaming. When the cache says the user has
+            # generations left, the reservation runs alongside the wait for the first token.
+            # A user on their last generation is likely to race their other streams for it.
+            if cached_generations_left is None or cached_generations_left <= 1:
+                if await run_in_threadpool(generation_quota.reserve, token_info['sub']) is None:
+                    raise HTTPException(
+                        status_code=status.HTTP_403_FORBIDDEN,
+                        detail="Generations limit exceeded",
+                    )
+                reservation = None
+            else:
+                reservation = asyncio.ensure_future(run_in_threadpool(generation_quota.reserve, token_info['sub']))
+        except BaseException:
+            admission.release()
+            raise
+
+        async def settle_turn(partial):
+            """Account for the cost of the generated turn and save it."""
+            with tracer.span("settle_turn", parent=stream_span, partial=partial):
+                generated_ai_message = token_counter.text
+                with tracer.span("calculate_cost", model=served_model):
+                    output_token_length = token_counter.output_tokens
+                    input_token_length = token_counter.input_tokens
+                    if input_token_length is None and cached_response is not None:
+                        input_token_length = cached_response['input_tokens']
+                    if input_token_length is None:
+                        input_token_length = await run_in_threadpool(count_input_tokens, served_model, chat_id, request.chat_history, request.user_input)
+
+                    # stats for the chat
+                    stats = {
+                        "input_token_length": input_token_length,
+                        "output_token_length": output_token_length,
+                        "cost": token_cost(input_token_length, output_token_length, served_model)
+                    }
+                if served_model != chat_model:
+                    stats["requested_model"] = chat_model
+                if cached_response is not None:
+                    # replayed from the response cache, the provider was not called
+                    stats["cost"] = 0
+                    stats["cached"] = True
+                else:
+                    chat_input_tokens_total.inc(served_model, amount=input_token_length)
+                    chat_output_tokens_total.inc(served_model, amount=output_token_length)
+                    chat_cost_dollars_total.inc(served_model, amount=stats["cost"])
+                    if not partial and served_model == chat_model:
+                        await response_cache.set(response_key, generated_ai_message, stats["cost"], input_token_length, output_token_length)
+                if partial:
+                    # the client left before the end, the turn holds what was generated until then
+                    stats["partial"] = True
+                stream_span.set_attributes(
+                    model=served_model,
+                    company=model_company_mapping[served_model]['company'],
+                    input_tokens=input_token_length,
+                    output_tokens=output_token_length,
+                    cost=stats["cost"],
+                    cached=cached_response is not None,
+                    partial=partial,
+                )
+                # count the new turn once so the next turns of the chat get it from the cache
+                turn_digest, turn_tokens = await run_in_threadpool(history_token_cache.count_turn, served_model, request.user_input, generated_ai_message)
+                token_counts = {turn_digest: turn_tokens} if history_token_cache.persist else None
+
+                # Database update after streaming is completed, saved in the background
+                saved = persistence_queue.submit({
+                    'turn_id': turn_id,
+                    'chat_id': chat_id,
+                    'new_chat': new_chat,
+                    'google_user_id': token_info['sub'],
+                    'user_message': request.user_input,
+                    'ai_message': generated_ai_message,
+                    'regenerate_message': request.regenerate_message,
+                    'model': served_model,
+                    'stats': stats,
+                    'token_counts': token_counts,
+                    'trace_parent': current_span.get(),
+                })
+                history_token_cache.remember(chat_id, turn_digest, turn_tokens)
+                if new_chat and not partial and TITLE_IN_BACKGROUND:
+                    # title the chat once its first turn is saved, off the response
+                    first_turns = request.chat_history + [ChatHistory(user_message=request.user_input, ai_message=generated_ai_message)]
+                    title_generator.start(chat_id, first_turns, token_info['sub'], after=saved)
+                await run_in_threadpool(conversation_history_store.append, chat_id, token_info['sub'], {
+                    'ai_message': generated_ai_message,
+                    'user_message': request.user_input,
+                    'regenerate_message': request.regenerate_message,
+                }, new_chat=new_chat)
+
+        async def stop_stream(chunks):
+            """Close the provider stream of a client that left and save the partial turn."""
+            await close_stream(chunks)
+            if reservation is not None and await reservation is None:
+                return
+            if not token_counter.text:
+                # nothing was generated, give the reserved generation back
+                await run_in_threadpool(generation_quota.refund, token_info['sub'])
+                return
+            await settle_turn(partial=True)
+
+        # Spans the stream until its end, parent of the provider requests and the turn's settlement
+        stream_span = tracer.start_span("provider_stream", model=chat_model, company=chat_config['company'])
+        # set by the generator once it runs, from then on it settles the slot and the reservation itself
+        stream_started = False
+
+        async def release_unstarted():
+            """Release the slot and refund the generation of a response cancelled before the stream started."""
+            admission.release()
+            if stream_started:
+                return
+            stream_span.set_attributes(outcome="disconnected", frames=0)
+            stream_span.end()
+            try:
+                if reservation is not None and await reservation is None:
+                    return
+            except Exception as e:
+                logging.error(f'Error reserving generation for user {token_info["sub"]}: {e}')
+                return
+            await run_in_threadpool(generation_quota.refund, token_info['sub'])
+
+        async def event_streaming():
+            nonlocal reservation, served_model, token_counter, stream_started
+            stream_started = True
+            if cached_response is not None:
+                chunks = response_cache.replay(cached_response)
+            else:
+                # Stream message chunks rather than parsed strings to keep the provider's usage metadata
+                chunks = provider_router.stream(chat_model, request.temperature, prompt, {"chat_history": history_messages, "user_input": request.user_input}, parent=stream_span)
+            backpressure = StreamBackpressure(SSE_COALESCE_MS / 1000, SSE_COALESCE_MAX_MS / 1000)
+            stream_completed = False
+            # Starlette cancels the response when the client disconnects, which
+            # reaches this generator as a CancelledError or GeneratorExit
+            client_left = True
+            outcome = "disconnected"
+            first_frame = True
+            try:
+                async for batch in coalesce_stream(chunks, backpressure.window):
+                    if reservation is not None:
+                        # shielded, a reservation is settled even when the response is cancelled
+                        reserved = await asyncio.shield(reservation)
+                        reservation = None
+                        if reserved is None:
+                            # another stream of the user spent the last generation meanwhile
+                            client_left = False
+                            outcome = "quota"
+                            await close_stream(chunks)
+                            yield error_encoder.frame("Generations limit exceeded", is_final=True)
+                            return
+                    if getattr(chunks, 'model_name', chat_model) != served_model:
+                        # a backup model answered first, count its tokens with its own tokenizer
+                        served_model = chunks.model_name
+                        token_counter = await run_in_threadpool(StreamingTokenCounter, served_model)
+                    token = "".join(token_counter.add(chunk) for chunk in batch)
+                    if first_frame:
+                        first_frame = False
+                        ttft = time.perf_counter() - request_started_at
+                        chat_ttft_seconds.observe(ttft, served_model)
+                        stream_span.set_attributes(ttft_ms=round(ttft * 1000, 1))
+                    frame_started_at = time.perf_counter()
+                    yield sse_encoder.frame(token, output_tokens=token_counter.output_tokens)
+                    backpressure.record_write(time.perf_counter() - frame_started_at)
+
+                stream_completed = True
+                if reservation is not None:
+                    reserved = await asyncio.shield(reservation)
+                    reservation = None
+                    if reserved is None:
+                        # the provider sent nothing before the last generation was spent
+                        client_left = False
+                        outcome = "quota"
+                        yield error_encoder.frame("Generations limit exceeded", is_final=True)
+                        return
+                # shielded, the turn is saved even if the client leaves meanwhile
+                await asyncio.shield(run_detached(settle_turn(partial=False)))
+                client_left = False
+                outcome = "completed"
+                yield sse_encoder.frame(is_final=True, chat_id=chat_id)
+            except Exception:
+                client_left = False
+                outcome = "error"
+                # the generation was not delivered, give the reserved generation back
+                if not stream_completed:
+                    if reservation is not None:
+                        reserved = await reservation
+                        reservation = None
+                        if reserved is None:
+                            raise
+                    await run_in_threadpool(generation_quota.refund, token_info['sub'])
+                raise
+            finally:
+                chat_streams_total.inc(served_model, outcome)
+                chat_stream_seconds.observe(time.perf_counter() - request_started_at, served_model)
+                stream_span.set_attributes(outcome=outcome, frames=backpressure.frames)
+                stream_span.end()
+                admission.release()
+                if client_left and not stream_completed:
+                    logging.info("Client disconnected, stopping the %s stream after %d frames.", chat_model, backpressure.frames)
+                    # run outside the cancelled response, which cannot await anymore
+                    run_detached(stop_stream(chunks))
+
+
+        return StreamingResponse(event_streaming(), media_type="text/event-stream", background=BackgroundTask(release_unstarted))
+    except ValidationError as ve:
+        # Handle validation errors specifically for better user feedback
+        logging.error("Validation error: %s", ve)
+        raise HTTPException(status_code=400, detail="Invalid request data") from ve
+    except HTTPException as he:
+        # Handle HTTP exceptions specifically for better user feedback
+        raise he
+    except Exception as e:
         # Log and handle generic exceptions gracefully
         logging.error("Error processing chat request: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
-# chats by chat_id
-@app.get("/v1/chat_by_id", tags=["AI Endpoints"], response_model=list[ChatByIdHistory])
-async def chat_by_id(chat_id: str, token_info: dict = Depends(verify_token)):
-    """Chat endpoint for the OpenAI chatbot."""
+@app.post("/v1/chat_compare", tags=["AI Endpoints"])
+async def chat_compare(request: ChatCompareRequest, token_info: dict = Depends(verify_token)):
+    """
+    Answer one input with several models at once, multiplexed on one SSE stream.
+
+    The frames of each answer carry its model, and each answer ends with a final
+    frame of its model. A final frame without model closes the stream. The history
+    is loaded, fitted and formatted once for all the models, the input tokens are
+    counted once per tokenizer, and each model is billed one generation. The
+    answers are not saved to the chat.
+    """
+    request_started_at = time.perf_counter()
     try:
-        # verify that chat_id belongs to the user using google_user_id inside token_info['sub']
-        chat_ref = db.collection('chats').where('chat_id', '==', chat_id).stream()
-        chat_data = next(chat_ref, None)
-
-        if chat_data:
-            chat_data = chat_data.to_dict()
-            if chat_data['google_user_id'] == token_info['sub']:
-                chat_history = []
-                chat_history_ref = db.collection('chat_history').where('chat_id', '==', chat_id).stream()
-                for chat_data in chat_history_ref:
-                    chat_data = chat_data.to_dict()
-                    chat_history.append(ChatByIdHistory(ai_message=chat_data['ai_message'], user_message=chat_data['user_message'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], regenerate_message=chat_data['regenerate_message'], model=chat_data['model']))
-                return chat_history
-            else:
+        chat_models = list(dict.fromkeys(request.chat_models))
+        if not 1 <= len(chat_models) <= COMPARE_MAX_MODELS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Compare 1 to {COMPARE_MAX_MODELS} models",
+            )
+        invalid_models = [chat_model for chat_model in chat_models if chat_model not in model_company_mapping]
+        if invalid_models:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid chat model: {', '.join(invalid_models)}",
+            )
+
+        cached_generations_left = await generation_quota.cached_remaining(token_info['sub'])
+        if cached_generations_left is not None and cached_generations_left < len(chat_models):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Generations limit exceeded",
+            )
+
+        # the rolling summary of the chat is read and extended, whichever history the client sent
+        if request.chat_id:
+            await run_in_threadpool(verify_chat_owner, request.chat_id, token_info['sub'])
+
+        # One history for all the models, fitted to the smallest context window
+        chat_history = await resolve_chat_history(request, token_info)
+        smallest_model = min(chat_models, key=lambda chat_model: model_company_mapping[chat_model]['context_window'])
+        chat_history = await history_compactor.compact(smallest_model, request.chat_id, chat_history, request.user_input)
+
+        prompt = ChatPromptTemplate(
+            messages=[
+                MessagesPlaceholder(variable_name="chat_history"),
+                HumanMessagePromptTemplate.from_template("{user_input}"),
+            ]
+        )
+        history_messages = []
+        for turn in chat_history:
+            history_messages.append(HumanMessage(content=turn.user_message))
+            history_messages.append(AIMessage(content=turn.ai_message))
+        inputs = {"chat_history": history_messages, "user_input": request.user_input}
+
+        # Each model takes a slot of its provider, the comparison counts once for the user's limit
+        admissions = await asyncio.gather(*(
+            admission_controller.admit(token_info['sub'], model_provider(model_company_mapping[chat_model]), user_slot=index == 0)
+            for index, chat_model in enumerate(chat_models)
+        ), return_exceptions=True)
+        refused = next((admission for admission in admissions if isinstance(admission, BaseException)), None)
+        if refused is not None:
+            for admission in admissions:
+                if not isinstance(admission, BaseException):
+                    admission.release()
+            raise refused
+
+        try:
+            # One transaction reserves the generations of every model
+            if await run_in_threadpool(generation_quota.reserve, token_info['sub'], len(chat_models)) is None:
                 raise HTTPException(
                     status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Forbidden",
+                    detail="Generations limit exceeded",
                 )
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Chat not found",
-            )
+        except BaseException:
+            for admission in admissions:
+                admission.release()
+            raise
+
+        # Input tokens of the prompt per tokenizer, shared by the models using the same one
+        input_token_counts = {}
+
+        def shared_input_tokens(model_name):
+            key = tokenizer_registry.key(model_name)
+            if key not in input_token_counts:
+                input_token_counts[key] = asyncio.ensure_future(run_in_threadpool(count_input_tokens, model_name, request.chat_id, chat_history, request.user_input))
+            # shielded, a cancelled answer does not cancel the count of the others
+            return asyncio.shield(input_token_counts[key])
+
+        # Answers put their frames here and None once they are settled, a slow client slows down every model
+        frames = asyncio.Queue(maxsize=16 * len(chat_models))
+        answers = []
+
+        async def settle_answer(chat_model, served_model, token_counter, outcome, stream_span):
+            """Account for the cost of one model's answer, or give its generation back."""
+            with tracer.span("settle_turn", parent=stream_span, partial=outcome != "completed"):
+                if token_counter.text and outcome != "error":
+                    input_token_length = token_counter.input_tokens
+                    if input_token_length is None:
+                        input_token_length = await shared_input_tokens(served_model)
+                    output_token_length = token_counter.output_tokens
+                    cost = token_cost(input_token_length, output_token_length, served_model)
+                    chat_input_tokens_total.inc(served_model, amount=input_token_length)
+                    chat_output_tokens_total.inc(served_model, amount=output_token_length)
+                    chat_cost_dollars_total.inc(served_model, amount=cost)
+                    stream_span.set_attributes(input_tokens=input_token_length, output_tokens=output_token_length, cost=cost)
+                else:
+                    # nothing was delivered, give the model's generation back
+                    await run_in_threadpool(generation_quota.refund, token_info['sub'])
+            chat_streams_total.inc(served_model, outcome)
+            chat_stream_seconds.observe(time.perf_counter() - request_started_at, served_model)
+            stream_span.set_attributes(served_model=served_model, outcome=outcome)
+            stream_span.end()
+
+        async def answer(chat_model, admission):
+            """Stream one model's answer into the frames queue."""
+            stream_span = tracer.start_span("provider_stream", model=chat_model, company=model_company_mapping[chat_model]['company'], compare=True)
+            served_model = chat_model
+            token_counter = None
+            chunks = None
+            outcome = "disconnected"
+            try:
+                token_counter = await run_in_threadpool(StreamingTokenCounter, chat_model)
+                chunks = provider_router.stream(chat_model, request.temperature, prompt, inputs, parent=stream_span)
+                first_frame = True
+                async for batch in coalesce_stream(chunks, SSE_COALESCE_MS / 1000):
+                    if getattr(chunks, 'model_name', chat_model) != served_model:
+                        # a backup model answered first, count its tokens with its own tokenizer
+                        served_model = chunks.model_name
+                        token_counter = await run_in_threadpool(StreamingTokenCounter, served_model)
+                    token = "".join(token_counter.add(chunk) for chunk in batch)
+                    if first_frame:
+                        first_frame = False
+                        chat_ttft_seconds.observe(time.perf_counter() - request_started_at, served_model)
+                    await frames.put(sse_encoder.frame(token, output_tokens=token_counter.output_tokens, model=chat_model))
+                outcome = "completed"
+            except Exception as e:
+                outcome = "error"
+                stream_span.record_error(e)
+                logging.error("Error streaming %s in a comparison: %s", chat_model, e)
+                await frames.put(error_encoder.frame("The model failed to answer", is_final=True, model=chat_model))
+            finally:
+                admission.release()
+                if chunks is not None:
+                    await close_stream(chunks)
+                if token_counter is not None:
+                    # shielded, the answer is settled even when the client left meanwhile
+                    await asyncio.shield(run_detached(settle_answer(chat_model, served_model, token_counter, outcome, stream_span)))
+                else:
+                    await run_in_threadpool(generation_quota.refund, token_info['sub'])
+                    stream_span.end()
+            if outcome == "completed":
+                await frames.put(sse_encoder.frame(is_final=True, output_tokens=token_counter.output_tokens, model=chat_model))
+            await frames.put(None)
+
+        async def compare_streaming():
+            answers.extend(run_detached(answer(chat_model, admission)) for chat_model, admission in zip(chat_models, admissions))
+            pending = len(answers)
+            try:
+                while pending:
+                    frame = await frames.get()
+                    if frame is None:
+                        pending -= 1
+                        continue
+                    yield frame
+                yield sse_encoder.frame(is_final=True)
+            finally:
+                # the client left, stop the streams that are still running, they settle what they generated
+                for task in answers:
+                    task.cancel()
+
+        async def release_unstarted():
+            """Release the slots and generations of a response cancelled before its stream started."""
+            if not answers:
+                for admission in admissions:
+                    admission.release()
+                for _ in chat_models:
+                    await run_in_threadpool(generation_quota.refund, token_info['sub'])
+
+        return StreamingResponse(compare_streaming(), media_type="text/event-stream", background=BackgroundTask(release_unstarted))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error("Error processing chat compare request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+
+
+async def verify_internal_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))):
+    """Let only the holders of INTERNAL_TOKEN use the internal endpoints, and nobody when it is unset."""
+    if not INTERNAL_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not Found",
+        )
+    if not (credentials and hmac.compare_digest(credentials.credentials, INTERNAL_TOKEN)):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.get("/v1/llm_pool_stats", tags=["Internal Endpoints"], dependencies=[Depends(verify_internal_token)])
+async def llm_pool_stats():
+    """Usage statistics of the pooled LLM clients."""
+    return llm_client_pool.stats()
+
+
+@app.get("/metrics", tags=["Internal Endpoints"], include_in_schema=False, dependencies=[Depends(verify_internal_token)])
+async def prometheus_metrics():
+    """Service metrics in the Prometheus text format."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/v1/traces", tags=["Internal Endpoints"], dependencies=[Depends(verify_internal_token)])
+async def recent_traces(trace_id: Optional[str] = None):
+    """Spans of the recent sampled traces kept by the in-memory exporter, as OTLP/JSON spans."""
+    if not isinstance(tracer.exporter, InMemorySpanExporter):
+        return []
+    return tracer.exporter.spans(trace_id)
+
+
+@app.get("/v1/provider_stats", tags=["Internal Endpoints"], dependencies=[Depends(verify_internal_token)])
+async def provider_stats():
+    """Fallbacks, hedged requests and the circuit state of the providers."""
+    return provider_router.stats()
+
+
+@app.get("/v1/admission_stats", tags=["Internal Endpoints"], dependencies=[Depends(verify_internal_token)])
+async def admission_stats():
+    """Provider slots in use and chat requests waiting for one."""
+    return admission_controller.stats()
+
+
+@app.get("/v1/response_cache_stats", tags=["Internal Endpoints"], dependencies=[Depends(verify_internal_token)])
+async def response_cache_stats():
+    """Hit rate of the response cache and the provider cost saved by its hits."""
+    return response_cache.stats()
+
+
+@app.get("/v1/generations", tags=["AI Endpoints"])
+async def get_generations_left(token_info: dict = Depends(verify_token)):
+    """Get the number of generations left for the user."""
+    try:
+        generations_left = await run_in_threadpool(get_generations, token_info)
+        return {"generations_left": generations_left}
+    except Exception as e:
+        logging.error("Error processing generations request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+
+def encode_cursor(values):
+    """Encode the order_by field values of the last returned document as an opaque cursor."""
+    values = {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in values.items()}
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, datetime_fields=()):
+    """Decode a cursor made by encode_cursor."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        for key in datetime_fields:
+            values[key] = datetime.datetime.fromisoformat(values[key])
+        return values
+    except (ValueError, KeyError, TypeError) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        ) from exc
+
+
+def list_user_chats(google_user_id, limit, cursor=None, offset=0):
+    """
+    Return a page of the user's chats, newest first, and the cursor of the next page.
+    Pages after the first are read with start_after on (updated_at, chat_id), so a deep
+    page costs the same reads as the first one. offset is kept for the page parameter.
+    """
+    chat_query = db.collection('chats').where(filter=FieldFilter('google_user_id', '==', google_user_id)) \
+        .order_by('updated_at', direction=google_firestore.Query.DESCENDING) \
+        .order_by('chat_id', direction=google_firestore.Query.DESCENDING)
+    if cursor:
+        chat_query = chat_query.start_after(decode_cursor(cursor, datetime_fields=('updated_at',)))
+    elif offset:
+        chat_query = chat_query.offset(offset)
+
+    with firestore_call('chats', 'query'):
+        chat_docs = list(chat_query.limit(limit).stream())
+    chat_history = []
+    for chat_data in chat_docs:
+        chat_data = chat_data.to_dict()
+        chat_history.append(ChatUserHistory(chat_id=chat_data['chat_id'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], chat_title=chat_data.get('chat_title', None) , chat_model=chat_data.get('model', 'gpt-3.5-turbo')))
+
+    next_cursor = None
+    if len(chat_history) == limit:
+        next_cursor = encode_cursor({'updated_at': chat_history[-1].updated_at, 'chat_id': chat_history[-1].chat_id})
+    return chat_history, next_cursor
+
+
+# chat history of the user
+@app.get("/v1/chat_history", tags=["AI Endpoints"], response_model=list[ChatUserHistory])
+async def user_chat_history(response: Response, page: int = Query(1, ge=1), limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, token_info: dict = Depends(verify_token)):
+    """
+    Chat history endpoint for the OpenAI chatbot.
+    Pass the X-Next-Cursor response header back as cursor to get the next page,
+    page is still accepted for older clients.
+    """
+    try:
+        # Calculate the starting index based on the page and limit, only used without a cursor
+        start_index = (page - 1) * limit
+
+        # Get the chat history from the database with pagination
+        chat_history, next_cursor = await run_in_threadpool(list_user_chats, token_info['sub'], limit, cursor, start_index)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+                    
+        return chat_history
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        # Log and handle generic exceptions gracefully
+        logging.error("Error processing chat history request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+    
+
+
+def update_chat_title(chat_id, new_chat_title, google_user_id):
+    """
+    Background task to update the chat title in the database.
+    """
+    try:
+        # merge, the first turn of the chat may still be in the persistence queue.
+        # The owner is written too so a chat created by the merge is never ownerless
+        chat_doc_ref = db.collection('chats').document(chat_id)
+        with firestore_call('chats', 'set'):
+            chat_doc_ref.set({
+                'google_user_id': google_user_id,
+                'chat_title': new_chat_title,
+                'updated_at': google_firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+    except Exception as e:
+        logging.error(f'Error updating chat title: {e}')
+
+
+
+TITLE_STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have having
+he her here hers herself him himself his how i if in into is it its itself just let me more most my myself
+no nor not now of off on once only or other our ours ourselves out over own please same she should so some
+such than that the their theirs them themselves then there these they this those through to too under
+until up very was we were what when where which while who whom why will with would you your yours yourself
+yourselves tell give show explain write make help want need know like get use using way thing things sure
+""".split())
+
+
+def extractive_title(chat_history, max_words=5):
+    """
+    Title a chat locally from its most distinctive words.
+
+    Every message is a document, words are scored by TF-IDF summed over the
+    messages with the user's messages counting double, and the best words are
+    kept in the order they first appear in the chat.
+    """
+    documents = []
+    for turn in chat_history:
+        documents.append((2, turn.user_message))
+        documents.append((1, turn.ai_message))
+    words_by_document = [
+        (weight, [word for word in re.findall(r"[a-z0-9][a-z0-9+#.'-]*[a-z0-9+#]|[a-z0-9]", text.lower()) if word not in TITLE_STOPWORDS and not word.isdigit()])
+        for weight, text in documents
+    ]
+    document_frequency = {}
+    first_position = {}
+    position = 0
+    for _, words in words_by_document:
+        for word in set(words):
+            document_frequency[word] = document_frequency.get(word, 0) + 1
+        for word in words:
+            first_position.setdefault(word, position)
+            position += 1
+    scores = {}
+    for weight, words in words_by_document:
+        for word in set(words):
+            term_frequency = words.count(word) / len(words)
+            inverse_document_frequency = math.log((1 + len(documents)) / (1 + document_frequency[word])) + 1
+            scores[word] = scores.get(word, 0) + weight * term_frequency * inverse_document_frequency
+    best_words = sorted(scores, key=lambda word: (-scores[word], first_position[word]))[:max_words]
+    title = " ".join(word.capitalize() for word in sorted(best_words, key=first_position.get))
+    return title or "New Chat"
+
+
+class TitleGenerator:
+    """
+    Generates chat titles from the start of the chat, cut to a token budget.
+
+    The title model gets the first turns of the chat up to budget tokens. The
+    local fallback titles the chat without a provider call when the model fails,
+    takes longer than timeout, or the user has few generations left.
+    """
+
+    MODEL = "gpt-4o-mini"
+    TEMPERATURE = 0.2
+    INSTRUCTION = "Generate a concise and relevant 5-word title for the above chat based on the main topic discussed. Do not include any creative or ambiguous terms."
+
+    def __init__(self, budget, timeout, local_below_generations, fallback=extractive_title):
+        self.budget = budget
+        self.timeout = timeout
+        self.local_below_generations = local_below_generations
+        self.fallback = fallback
+        # chat_id -> task of the title being generated in the background
+        self.in_flight = {}
+
+    def truncate(self, chat_history):
+        """Keep the first turns of the chat that fit in the token budget."""
+        remaining = self.budget
+        turns = []
+        for turn in chat_history:
+            turn_tokens = tokenizer_registry.count_tokens(self.MODEL, turn.user_message + turn.ai_message)
+            if turn_tokens <= remaining:
+                turns.append(turn)
+                remaining -= turn_tokens
+                continue
+            # cut the turn that crosses the budget in proportion to its length
+            keep = remaining / max(turn_tokens, 1)
+            if keep > 0.1:
+                turns.append(ChatHistory(
+                    user_message=turn.user_message[:int(len(turn.user_message) * keep)],
+                    ai_message=turn.ai_message[:int(len(turn.ai_message) * keep)],
+                ))
+            break
+        return turns
+
+    async def _generate(self, chat_history):
+        response_key = response_cache.key(self.MODEL, self.TEMPERATURE, chat_history, self.INSTRUCTION)
+        cached_response = await response_cache.get(response_key)
+        if cached_response is not None:
+            return cached_response['text']
+        prompt = ChatPromptTemplate(
+            messages=[
+                MessagesPlaceholder(variable_name="chat_history"),
+                HumanMessagePromptTemplate.from_template("{user_input}"),
+            ]
+        )
+        chain = prompt | llm_client_pool.get(self.MODEL, self.TEMPERATURE) | StrOutputParser()
+        history_messages = []
+        for turn in chat_history:
+            history_messages.append(HumanMessage(content=turn.user_message))
+            history_messages.append(AIMessage(content=turn.ai_message))
+        title = await chain.ainvoke({"chat_history": history_messages, "user_input": self.INSTRUCTION})
+        # clean the response of extra "" or /
+        title = title.replace('"', '').replace("/", "").strip()
+        if response_key:
+            title_input = prompt.format(chat_history=history_messages, user_input=self.INSTRUCTION)
+            input_token_length, output_token_length, cost = await run_in_threadpool(calculate_cost, title_input, title, self.MODEL)
+            await response_cache.set(response_key, title, cost, input_token_length, output_token_length)
+        return title
+
+    async def title(self, chat_history, google_user_id):
+        """Return the title of a chat, from the model or the local fallback."""
+        chat_history = await run_in_threadpool(self.truncate, chat_history)
+        remaining_generations = await generation_quota.cached_remaining(google_user_id)
+        if remaining_generations is not None and remaining_generations < self.local_below_generations:
+            return self.fallback(chat_history)
+        try:
+            title = await asyncio.wait_for(self._generate(chat_history), self.timeout)
+        except Exception as e:
+            logging.warning(f'Falling back to a local chat title: {e!r}')
+            return self.fallback(chat_history)
+        return title or self.fallback(chat_history)
+
+    def start(self, chat_id, chat_history, google_user_id, after=None):
+        """Title a new chat in the background, remembering the task until it is done."""
+        task = run_detached(self.title_chat(chat_id, chat_history, google_user_id, after=after))
+        self.in_flight[chat_id] = task
+
+        def forget(done_task):
+            if self.in_flight.get(chat_id) is done_task:
+                del self.in_flight[chat_id]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def wait(self, chat_id):
+        """Wait up to timeout for the background title of the chat, if one is being generated."""
+        task = self.in_flight.get(chat_id)
+        if task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'Background title of chat {chat_id} still running after {self.timeout}s')
+
+    async def title_chat(self, chat_id, chat_history, google_user_id, after=None):
+        """Background task titling a new chat once the after future, its first turn being saved, is done."""
+        try:
+            if after is not None:
+                await after
+            chat_title = await self.title(chat_history, google_user_id)
+            await run_in_threadpool(update_chat_title, chat_id, chat_title, google_user_id)
+            await generated_titles.aset(chat_id, chat_title)
+        except Exception as e:
+            logging.error(f'Error titling chat {chat_id}: {e}')
+
+
+title_generator = TitleGenerator(TITLE_HISTORY_TOKEN_BUDGET, TITLE_TIMEOUT, TITLE_LOCAL_BELOW_GENERATIONS)
+# Titles generated in the background, answered by /v1/chat_title without generating them again
+generated_titles = create_cache('chat_titles', CHAT_OWNER_CACHE_SIZE, ttl=CHAT_OWNER_CACHE_TTL)
+
+
+# title of the chat generater
+@app.post("/v1/chat_title", tags=["AI Endpoints"])
+async def chat_title(request: ChatRequest, token_info: dict = Depends(verify_token)):
+    """Chat endpoint for the OpenAI chatbot."""
+    try:
+        # the title generated in the background after the first turn, if there is one
+        if request.chat_id:
+            await run_in_threadpool(verify_chat_owner, request.chat_id, token_info['sub'])
+            await title_generator.wait(request.chat_id)
+            chat_title = await generated_titles.aget(request.chat_id)
+            if chat_title is not None:
+                return ChatResponse(response=chat_title)
+
+        request.chat_history = await resolve_chat_history(request, token_info)
+
+        # Titles do not spend generations, the local fallback covers users low on them
+        chat_title = await title_generator.title(request.chat_history, token_info['sub'])
+
+        # Database update after streaming is completed
+        if request.chat_id:
+            await run_in_threadpool(update_chat_title, request.chat_id, chat_title, token_info['sub'])
+            await generated_titles.aset(request.chat_id, chat_title)
+
+        return ChatResponse(response=chat_title)
+    except ValidationError as ve:
+        # Handle validation errors specifically for better user feedback
+        logging.error("Validation error: %s", ve)
+        raise HTTPException(status_code=400, detail="Invalid request data") from ve
+    except HTTPException as he:
+        # Handle HTTP exceptions specifically for better user feedback
+        raise he
+    except Exception as e:
+        # Log and handle generic exceptions gracefully
+        logging.error("Error processing chat request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+
+
+def chat_turns_query(chat_id, limit=None, cursor=None):
+    """Query the turns of a chat newest first, continuing after cursor when given."""
+    chat_history_ref = db.collection('chat_history')
+    chat_history_query = chat_history_ref.where(filter=FieldFilter('chat_id', '==', chat_id)) \
+        .order_by('created_at', direction=google_firestore.Query.DESCENDING) \
+        .order_by(google_firestore.FieldPath.document_id(), direction=google_firestore.Query.DESCENDING)
+    if cursor:
+        cursor_values = decode_cursor(cursor, datetime_fields=('created_at',))
+        chat_history_query = chat_history_query.start_after({
+            'created_at': cursor_values['created_at'],
+            '__name__': chat_history_ref.document(cursor_values['id']),
+        })
+    if limit:
+        chat_history_query = chat_history_query.limit(limit)
+    return chat_history_query
+
+
+def to_chat_by_id_history(chat_data):
+    """Build the response model of a chat_history document."""
+    return ChatByIdHistory(ai_message=chat_data['ai_message'], user_message=chat_data['user_message'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], regenerate_message=chat_data['regenerate_message'], model=chat_data['model'])
+
+
+def turn_cursor(chat_doc):
+    """Cursor continuing after the given chat_history document."""
+    return encode_cursor({'created_at': chat_doc.get('created_at'), 'id': chat_doc.id})
+
+
+def verify_chat_owner(chat_id, google_user_id):
+    """Raise 404 if the chat does not exist and 403 if it belongs to another user."""
+    chat_owner = get_chat_owner(chat_id)
+    if not chat_owner:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chat not found",
+        )
+    if chat_owner != google_user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Forbidden",
+        )
+
+
+def list_chat_turns(chat_id, limit=None, cursor=None):
+    """Return a page of the chat's turns, newest first, and the cursor of the older turns."""
+    with firestore_call('chat_history', 'query'):
+        chat_docs = list(chat_turns_query(chat_id, limit, cursor).stream())
+    chat_history = []
+    last_chat_doc = None
+    for chat_doc in chat_docs:
+        chat_history.append(to_chat_by_id_history(chat_doc.to_dict()))
+        last_chat_doc = chat_doc
+    next_cursor = turn_cursor(last_chat_doc) if limit and len(chat_history) == limit else None
+    return chat_history, next_cursor
+
+
+# chats by chat_id
+@app.get("/v1/chat_by_id", tags=["AI Endpoints"], response_model=list[ChatByIdHistory])
+async def chat_by_id(chat_id: str, response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, token_info: dict = Depends(verify_token)):
+    """
+    Chat endpoint for the OpenAI chatbot.
+    Turns are returned newest first. With limit, the X-Next-Cursor response header
+    is the cursor that loads the older turns; without it the whole chat is returned.
+    """
+    try:
+        # verify that chat_id belongs to the user using google_user_id inside token_info['sub']
+        await run_in_threadpool(verify_chat_owner, chat_id, token_info['sub'])
+
+        chat_history, next_cursor = await run_in_threadpool(list_chat_turns, chat_id, limit, cursor)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return chat_history
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error("Error processing chat request: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+
+
+@app.get("/v1/chat_by_id/stream", tags=["AI Endpoints"])
+async def chat_by_id_stream(chat_id: str, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, token_info: dict = Depends(verify_token)):
+    """
+    Stream the turns of a chat as NDJSON, newest first, as they are read from Firestore.
+    Each line is a turn with the cursor that continues after it.
+    """
+    try:
+        await run_in_threadpool(verify_chat_owner, chat_id, token_info['sub'])
+
+        def turn_lines():
+            for chat_doc in chat_turns_query(chat_id, limit, cursor).stream():
+                turn = jsonable_encoder(to_chat_by_id_history(chat_doc.to_dict()))
+                turn['cursor'] = turn_cursor(chat_doc)
+                yield json.dumps(turn) + "\n"
+
+        return StreamingResponse(iterate_in_threadpool(turn_lines()), media_type="application/x-ndjson")
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logging.error("Error processing chat request: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
@@ -910,7 +3868,7 @@ async def create_order(plan_id: str, token_info: dict = Depends(verify_token)):
         }
 
     
-        order = Order(client).create(order_data)
+        order = get_razorpay_client().order.create(order_data)
         # save the order into the orders collection
         db.collection('orders').add({
             'order_id': order['id'],
@@ -970,7 +3928,7 @@ async def verify_payment(request: PaymentRequest, token_info: dict = Depends(ver
                 detail="Invalid signature",
             )
 
-        order_data = Order(client).fetch(request.razorpay_order_id)
+        order_data = get_razorpay_client().order.fetch(request.razorpay_order_id)
         # check if the order is paid
         if order_data['status'] == 'paid':
             
@@ -981,26 +3939,14 @@ async def verify_payment(request: PaymentRequest, token_info: dict = Depends(ver
                 'created_at': google_firestore.SERVER_TIMESTAMP,
                 'updated_at': google_firestore.SERVER_TIMESTAMP,
             })
+            # the user's chats go ahead of the free users' from now on
+            await admission_controller.paying_users.aset(token_info['sub'], True)
 
-            # get the current remaining generations for the user
-            generations_left = get_generations(token_info)
-
-            # update user_generations collection by adding the remaining generations
-            if order_data['receipt'] == 'plan_50':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 50 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
-            elif order_data['receipt'] == 'plan_250':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 250 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
-            elif order_data['receipt'] == 'plan_500':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 500 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
+            # make sure the user has a generations document, then add the purchased generations atomically
+            get_generations(token_info)
+            purchased_generations = {'plan_50': 50, 'plan_250': 250, 'plan_500': 500}.get(order_data['receipt'])
+            if purchased_generations:
+                generation_quota.credit(token_info['sub'], purchased_generations)
 
             return {"status": "success"}
         else:
@@ -1059,7 +4005,7 @@ async def fetch_payment(payment_id: str, token_info: dict = Depends(verify_token
 
         if payment_data:
             # fetch the payment details
-            payment_data = Payment(client).fetch(payment_id)
+            payment_data = get_razorpay_client().payment.fetch(payment_id)
             payment_payload = {
                 "id": payment_data['id'],
                 "order_id": payment_data['order_id'],
@@ -1083,5 +4029,5 @@ async def fetch_payment(payment_id: str, token_info: dict = Depends(verify_token
 
 if __name__ == "__main__":
 
-    # Use multiprocessing for parallel request handling
+    # Single process server for development, production runs several workers with gunicorn -c gunicorn.conf.py
     uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
@@ -0,0 +1 @@
+"""Offline benchmarks for the chat-with-llms backend."""
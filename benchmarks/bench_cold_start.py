@@ -0,0 +1,83 @@
+"""Cold start benchmark: import time of the app and time to its first request.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter and
+reports the slowest imports, then starts uvicorn and measures the time
+until the first request is answered. Exits with status 1 when a budget is
+exceeded, so it can guard cold start in CI.
+
+Usage:
+    python -m benchmarks.bench_cold_start --import-budget 2.0 --first-request-budget 4.0
+"""
+import argparse
+import subprocess
+import sys
+import time
+import urllib.request
+
+from benchmarks.common import benchmark_env, free_port
+
+
+def measure_imports(top):
+    """Return the total import time in seconds and the slowest top-level imports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        env=benchmark_env(), capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Top-level imports are the ones without indentation in the tree
+        if cumulative_us.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative_us) / 1e6, name.strip()))
+    app_import = next((seconds for seconds, name in imports if name == "app"), sum(seconds for seconds, _ in imports))
+    return app_import, sorted(imports, reverse=True)[:top]
+
+
+def measure_first_request(timeout):
+    """Start uvicorn and return the seconds until /openapi.json answers."""
+    port = free_port()
+    started_at = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        env=benchmark_env(),
+    )
+    try:
+        while time.perf_counter() - started_at < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/openapi.json", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started_at
+            except OSError:
+                time.sleep(0.05)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args):
+    import_time, slowest = measure_imports(args.top)
+    print(f"import app: {import_time:.3f}s (budget {args.import_budget}s)")
+    for seconds, name in slowest:
+        print(f"  {seconds:>7.3f}s  {name}")
+
+    first_request = measure_first_request(args.timeout)
+    if first_request is None:
+        print(f"first request: no answer within {args.timeout}s")
+        sys.exit(1)
+    print(f"time to first request: {first_request:.3f}s (budget {args.first_request_budget}s)")
+
+    if import_time > args.import_budget or first_request > args.first_request_budget:
+        print("FAILED: cold start over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import-budget", type=float, default=2.0)
+    parser.add_argument("--first-request-budget", type=float, default=4.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--top", type=int, default=15)
+    main(parser.parse_args())
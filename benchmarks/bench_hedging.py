@@ -0,0 +1,97 @@
+"""Benchmark of provider fallback and hedged requests against fake providers.
+
+Two fake providers serve equivalent models. The primary has a slow first
+token tail and fails some requests. The backup is healthy. The same requests
+are routed without fallback, with fallback on errors, and with hedging after
+a time to first token deadline. For each mode the benchmark reports the TTFT
+percentiles, the failed requests and which model served the streams.
+
+Usage:
+    python -m benchmarks.bench_hedging --requests 500 --hedge-after 0.5
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import time
+
+from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+
+from benchmarks.common import load_app, percentile
+from benchmarks.fakes import FakeStreamingChatModel
+
+app = load_app()
+
+PRIMARY = "fake-primary"
+BACKUP = "fake-backup"
+
+
+def install_fakes(args):
+    """Register the fake providers, with a context window no real model matches."""
+    for model_name, provider, fake_options in (
+        (PRIMARY, "FakePrimary", {"failure_rate": args.failure_rate, "tail_rate": args.tail_rate, "tail_ttft": args.tail_ttft}),
+        (BACKUP, "FakeBackup", {}),
+    ):
+        app.model_company_mapping[model_name] = {
+            "model": functools.partial(FakeStreamingChatModel, ttft=args.ttft, token_interval=args.token_interval, num_tokens=args.tokens, **fake_options),
+            "premium": True,
+            "company": provider,
+            "provider": provider,
+            "input_token_cost_per_million": 1.0,
+            "output_token_cost_per_million": 1.0,
+            "context_window": 10 ** 9,
+        }
+
+
+async def run_stream(router, prompt):
+    started_at = time.perf_counter()
+    stream = router.stream(PRIMARY, 0.0, prompt, {"user_input": "Write a short paragraph"})
+    try:
+        async for _chunk in stream:
+            return time.perf_counter() - started_at, stream.model_name
+    except Exception:
+        return None, None
+    finally:
+        await stream.aclose()
+
+
+async def run_mode(args, hedge_after, fallback):
+    router = app.ProviderRouter(app.model_company_mapping, hedge_after, fallback, args.failure_threshold, args.reset_timeout)
+    prompt = ChatPromptTemplate(messages=[HumanMessagePromptTemplate.from_template("{user_input}")])
+    ttfts = []
+    served = collections.Counter()
+    failed = 0
+    for start in range(0, args.requests, args.concurrency):
+        batch = min(args.concurrency, args.requests - start)
+        for ttft, model_name in await asyncio.gather(*(run_stream(router, prompt) for _ in range(batch))):
+            if ttft is None:
+                failed += 1
+                continue
+            ttfts.append(ttft)
+            served[model_name] += 1
+    return ttfts, served, failed, router.stats()
+
+
+async def main(args):
+    install_fakes(args)
+    print(f"primary: ttft={args.ttft}s, {args.tail_rate:.0%} at {args.tail_ttft}s, {args.failure_rate:.0%} failures")
+    print(f"{'mode':<10} {'ttft p50':>9} {'ttft p99':>9} {'failed':>7} {'primary':>8} {'backup':>7} {'hedges':>7} {'fallbacks':>10}")
+    for name, hedge_after, fallback in (("direct", 0, False), ("fallback", 0, True), ("hedged", args.hedge_after, True)):
+        ttfts, served, failed, stats = await run_mode(args, hedge_after, fallback)
+        print(f"{name:<10} {percentile(ttfts, 50):>8.3f}s {percentile(ttfts, 99):>8.3f}s {failed:>7} {served[PRIMARY]:>8} {served[BACKUP]:>7} {stats['hedges']:>7} {stats['fallbacks']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=16)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--tail-rate", type=float, default=0.1)
+    parser.add_argument("--tail-ttft", type=float, default=2.0)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--hedge-after", type=float, default=0.5)
+    parser.add_argument("--failure-threshold", type=int, default=5)
+    parser.add_argument("--reset-timeout", type=float, default=30.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,69 @@
+"""Benchmark of /v1/chat_history pagination against the Firestore emulator.
+
+Seeds one user with many chats and times every page read with offset
+pagination (the page parameter) and with cursor pagination. With offsets
+Firestore scans and bills every skipped document, so deep pages get slower;
+with cursors every page costs the same.
+
+Usage:
+    gcloud emulators firestore start --host-port=localhost:8085
+    FIRESTORE_EMULATOR_HOST=localhost:8085 python -m benchmarks.bench_pagination --chats 2000
+"""
+import argparse
+import datetime
+import time
+import uuid
+
+from benchmarks.common import load_app
+
+app = load_app()
+
+
+def seed_chats(google_user_id, chats):
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    batch = app.db.batch()
+    for index in range(chats):
+        chat_id = str(uuid.uuid4())
+        created_at = started_at - datetime.timedelta(minutes=index)
+        batch.set(app.db.collection('chats').document(chat_id), {
+            'chat_id': chat_id,
+            'google_user_id': google_user_id,
+            'created_at': created_at,
+            'updated_at': created_at,
+            'model': 'gpt-4o-mini',
+        })
+        if index % 400 == 399:
+            batch.commit()
+            batch = app.db.batch()
+    batch.commit()
+
+
+def main(args):
+    google_user_id = f"pagination-benchmark-{uuid.uuid4()}"
+    seed_chats(google_user_id, args.chats)
+    pages = args.chats // args.limit
+    print(f"{args.chats} chats, {pages} pages of {args.limit}")
+    print(f"{'page':>6} {'offset':>10} {'docs read':>10} {'cursor':>10} {'docs read':>10}")
+
+    cursor = None
+    for page in range(1, pages + 1):
+        started_at = time.perf_counter()
+        offset_page, _ = app.list_user_chats(google_user_id, args.limit, offset=(page - 1) * args.limit)
+        offset_time = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        cursor_page, cursor = app.list_user_chats(google_user_id, args.limit, cursor=cursor)
+        cursor_time = time.perf_counter() - started_at
+
+        assert [chat.chat_id for chat in offset_page] == [chat.chat_id for chat in cursor_page]
+        if page == 1 or page == pages or page % args.report_every == 0:
+            # Skipped documents are billed as reads with offsets
+            print(f"{page:>6} {offset_time * 1000:>8.1f}ms {page * args.limit:>10} {cursor_time * 1000:>8.1f}ms {args.limit:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--report-every", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,330 @@
+"""Offline load test replaying recorded traffic against the app.
+
+Boots the app in process with fake LLM providers, an in-memory Firestore and
+locally minted access tokens, then replays a JSONL trace at its recorded pace
+through the ASGI interface, middleware included. No API keys, Firestore or
+network are needed. Reports the throughput, the TTFT and latency percentiles
+per endpoint, the Firestore round trips, reads and writes per chat turn, and
+the memory held per active stream (measured in a second pass under
+tracemalloc, which slows the app down).
+
+Each trace line is one request:
+
+    {"at": 0.25, "user": "user-1", "chat": "user-1/0", "method": "POST",
+     "path": "/v1/chat_event_streaming", "json": {"user_input": "...", "chat_model": "gpt-4o-mini"}}
+
+at is the offset in seconds from the start of the trace. Requests with the
+same chat label run one after the other, and get the chat_id the first turn
+of the chat was saved under. Requests to /auth/google go through a stubbed
+Google userinfo endpoint.
+
+Usage:
+    python -m benchmarks.bench_replay --synthesize benchmarks/traces/synthetic.jsonl --users 50 --rate 20
+    python -m benchmarks.bench_replay benchmarks/traces/sample.jsonl --ttft 0.3 --tokens-per-second 50
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import functools
+import json
+import random
+import time
+import tracemalloc
+
+import httpx
+
+from benchmarks.common import load_app, percentile
+from benchmarks.fakes import FakeFirestore, FakeStreamingChatModel, fake_firestore_module
+
+app = load_app()
+
+STREAMING_PATHS = ("/v1/chat_event_streaming", "/v1/chat_compare")
+USER_INPUTS = (
+    "Write a short paragraph about the sea",
+    "Explain how a hash map works",
+    "Give me three ideas for a birthday dinner",
+    "Summarize the plot of Hamlet in a few lines",
+    "What is the difference between a process and a thread?",
+)
+
+
+def synthesize(path, args):
+    """Write a trace of users chatting at a Poisson arrival rate, with a few history and generations reads."""
+    rng = random.Random(args.seed)
+    models = args.models or ["gpt-4o-mini"]
+    records = []
+    at = 0.0
+    for user_index in range(args.users):
+        user = f"user-{user_index}"
+        at += rng.expovariate(args.rate)
+        turn_at = at
+        records.append({"at": round(turn_at, 3), "user": user, "method": "GET", "path": "/v1/generations"})
+        records.append({"at": round(turn_at, 3), "user": user, "method": "GET", "path": "/v1/chat_history?limit=10"})
+        for chat_index in range(args.chats_per_user):
+            chat = f"{user}/{chat_index}"
+            for _turn in range(args.turns_per_chat):
+                records.append({
+                    "at": round(turn_at, 3),
+                    "user": user,
+                    "chat": chat,
+                    "method": "POST",
+                    "path": "/v1/chat_event_streaming",
+                    "json": {"user_input": rng.choice(USER_INPUTS), "chat_model": rng.choice(models), "temperature": 0.7},
+                })
+                # the user reads the answer before the next message
+                turn_at += args.think_time * rng.uniform(0.5, 1.5)
+    records.sort(key=lambda record: record["at"])
+    with open(path, "w") as trace_file:
+        for record in records:
+            trace_file.write(json.dumps(record) + "\n")
+    print(f"wrote {len(records)} requests of {args.users} users to {path}")
+
+
+def load_trace(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def install_fakes(args, trace):
+    """Swap the providers, Firestore and Google for fakes, and give the trace users enough generations."""
+    fake_model = functools.partial(
+        FakeStreamingChatModel,
+        ttft=args.ttft,
+        token_interval=1 / args.tokens_per_second,
+        num_tokens=args.tokens,
+        failure_rate=args.failure_rate,
+    )
+    # Every model keeps its company, provider name, prices and context window, only the provider is fake
+    for config in app.model_company_mapping.values():
+        config["provider"] = app.model_provider(config)
+        config["model"] = fake_model
+
+    app.db = FakeFirestore(latency=args.db_latency)
+    app.google_firestore = fake_firestore_module
+    for user in {record["user"] for record in trace}:
+        app.db.collection('user_generations').document(user).set({'google_user_id': user, 'remaining_generations': 10 ** 6})
+    app.db.ops.clear()
+
+    def google_userinfo(request):
+        token = request.headers["Authorization"].split(" ", 1)[1]
+        return httpx.Response(200, json={"sub": token, "email": f"{token}@example.com", "name": token, "picture": ""})
+
+    app.google_http_client = httpx.AsyncClient(transport=httpx.MockTransport(google_userinfo))
+
+
+def access_token(user):
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    return app.jwt.encode({"sub": user, "exp": expires_at}, app.SECRET_KEY, algorithm="HS256")
+
+
+async def asgi_request(method, path, token, body=None):
+    """Send one request through the ASGI app, return the status and the body chunks with their arrival times."""
+    path, _, query = path.partition("?")
+    payload = json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"benchmark"),
+            (b"authorization", f"Bearer {token}".encode()),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(payload)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    response_done = asyncio.Event()
+    request_sent = False
+    status_code = None
+    chunks = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        # the client stays until the whole response is read
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+        elif message["type"] == "http.response.body":
+            if message.get("body"):
+                chunks.append((time.perf_counter(), message["body"]))
+            if not message.get("more_body"):
+                response_done.set()
+
+    await app.app(scope, receive, send)
+    response_done.set()
+    return status_code, chunks
+
+
+class Replay:
+    """Replays a trace once and collects the measurements."""
+
+    def __init__(self, trace, speed, measure_memory=False):
+        self.trace = trace
+        self.speed = speed
+        self.measure_memory = measure_memory
+        self.results = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.chat_ids = {}
+        self.active_streams = 0
+        self.memory_baseline = 0
+        # (traced bytes above the baseline, active streams) at the busiest moment
+        self.memory_peak = (0, 0)
+        self.completed_turns = 0
+
+    def sample_memory(self):
+        if self.measure_memory and self.active_streams:
+            current, _peak = tracemalloc.get_traced_memory()
+            if self.active_streams > self.memory_peak[1] or (self.active_streams == self.memory_peak[1] and current - self.memory_baseline > self.memory_peak[0]):
+                self.memory_peak = (current - self.memory_baseline, self.active_streams)
+
+    async def run_request(self, record, started_at, previous_turn):
+        await asyncio.sleep(max(0.0, started_at + record["at"] / self.speed - time.perf_counter()))
+        if previous_turn is not None:
+            # the user waits for the answer of the previous turn of the chat
+            await previous_turn
+        body = dict(record["json"]) if record.get("json") else None
+        if body is not None and record.get("chat") in self.chat_ids:
+            body["chat_id"] = self.chat_ids[record["chat"]]
+        # the stubbed Google userinfo endpoint takes the user as access token
+        token = record["user"] if record["path"].startswith("/auth/google") else access_token(record["user"])
+        path = record["path"].partition("?")[0]
+        streaming = path in STREAMING_PATHS
+
+        sent_at = time.perf_counter()
+        if streaming:
+            self.active_streams += 1
+        try:
+            status_code, chunks = await asgi_request(record.get("method", "GET"), record["path"], token, body)
+        finally:
+            if streaming:
+                self.sample_memory()
+                self.active_streams -= 1
+        self.statuses[path][status_code] += 1
+        if status_code != 200 or not chunks:
+            return
+        self.results[path].append((chunks[0][0] - sent_at, chunks[-1][0] - sent_at))
+        if path == "/v1/chat_event_streaming":
+            self.completed_turns += 1
+            final = json.loads(chunks[-1][1].decode().strip().rsplit("\n\n", 1)[-1][len("data: "):])
+            if record.get("chat") and final.get("chat_id"):
+                self.chat_ids[record["chat"]] = final["chat_id"]
+
+    async def run(self):
+        if self.measure_memory:
+            tracemalloc.start()
+            self.memory_baseline = tracemalloc.get_traced_memory()[0]
+        started_at = time.perf_counter()
+        tasks = []
+        last_turns = {}
+        for record in self.trace:
+            task = asyncio.ensure_future(self.run_request(record, started_at, last_turns.get(record.get("chat"))))
+            if record.get("chat"):
+                last_turns[record["chat"]] = task
+            tasks.append(task)
+        # sample while the streams run, not only when they end
+        sampler = asyncio.ensure_future(self.sample_periodically()) if self.measure_memory else None
+        await asyncio.gather(*tasks)
+        self.wall_time = time.perf_counter() - started_at
+        if sampler is not None:
+            sampler.cancel()
+            tracemalloc.stop()
+        await app.persistence_queue.flush()
+
+    async def sample_periodically(self):
+        while True:
+            await asyncio.sleep(0.05)
+            self.sample_memory()
+
+
+def print_report(replay, ops):
+    requests = sum(sum(statuses.values()) for statuses in replay.statuses.values())
+    print(f"{requests} requests in {replay.wall_time:.2f}s: {requests / replay.wall_time:.1f} req/s, "
+          f"{replay.completed_turns / replay.wall_time:.1f} chat turns/s")
+    print(f"{'endpoint':<28} {'ok':>6} {'failed':>7} {'ttft p50':>9} {'ttft p90':>9} {'ttft p99':>9} {'total p50':>10} {'total p99':>10}")
+    report = {"wall_time": replay.wall_time, "requests": requests, "chat_turns": replay.completed_turns, "endpoints": {}}
+    for path, statuses in sorted(replay.statuses.items()):
+        ttfts = [ttft for ttft, _ in replay.results[path]]
+        totals = [total for _, total in replay.results[path]]
+        failed = sum(count for status_code, count in statuses.items() if status_code != 200)
+        endpoint = {
+            "ok": statuses[200],
+            "failed": dict((str(status_code), count) for status_code, count in statuses.items() if status_code != 200),
+            "ttft_p50": percentile(ttfts, 50), "ttft_p90": percentile(ttfts, 90), "ttft_p99": percentile(ttfts, 99),
+            "total_p50": percentile(totals, 50), "total_p99": percentile(totals, 99),
+        }
+        report["endpoints"][path] = endpoint
+        print(f"{path:<28} {statuses[200]:>6} {failed:>7} {endpoint['ttft_p50'] * 1000:>7.1f}ms {endpoint['ttft_p90'] * 1000:>7.1f}ms "
+              f"{endpoint['ttft_p99'] * 1000:>7.1f}ms {endpoint['total_p50'] * 1000:>8.1f}ms {endpoint['total_p99'] * 1000:>8.1f}ms")
+
+    turns = max(replay.completed_turns, 1)
+    report["firestore_per_turn"] = {name: count / turns for name, count in ops.items()}
+    print("firestore per chat turn: " + ", ".join(f"{count / turns:.2f} {name}" for name, count in sorted(ops.items())))
+    return report
+
+
+async def main(args):
+    if args.synthesize:
+        synthesize(args.synthesize, args)
+        return
+    trace = load_trace(args.trace)
+    install_fakes(args, trace)
+    await app.app.router.startup()
+    try:
+        print(f"{len(trace)} requests from {args.trace} at {args.speed}x, fake providers: ttft={args.ttft}s, "
+              f"{args.tokens} tokens at {args.tokens_per_second}/s, {args.failure_rate:.0%} failures, firestore round trip={args.db_latency}s")
+        replay = Replay(trace, args.speed)
+        await replay.run()
+        # Firestore ops of the first pass only, the memory pass writes the same again
+        report = print_report(replay, app.db.ops)
+
+        if not args.skip_memory:
+            memory = Replay(trace, args.speed, measure_memory=True)
+            await memory.run()
+            traced_bytes, streams = memory.memory_peak
+            report["memory_per_stream"] = traced_bytes / streams if streams else None
+            if streams:
+                print(f"memory: {traced_bytes / 2 ** 20:.1f} MiB traced above the baseline with {streams} active streams, "
+                      f"{traced_bytes / streams / 2 ** 10:.1f} KiB per stream")
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(report, output_file, indent=2)
+    finally:
+        await app.app.router.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", nargs="?", default="benchmarks/traces/sample.jsonl")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay the trace this many times faster")
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--db-latency", type=float, default=0.02)
+    parser.add_argument("--skip-memory", action="store_true")
+    parser.add_argument("--output", help="also write the report as JSON to this file")
+    synthetic = parser.add_argument_group("synthetic traces")
+    synthetic.add_argument("--synthesize", metavar="PATH", help="write a synthetic trace to PATH instead of replaying")
+    synthetic.add_argument("--users", type=int, default=20)
+    synthetic.add_argument("--chats-per-user", type=int, default=1)
+    synthetic.add_argument("--turns-per-chat", type=int, default=3)
+    synthetic.add_argument("--rate", type=float, default=5.0, help="new users per second")
+    synthetic.add_argument("--think-time", type=float, default=5.0, help="seconds between the turns of a chat")
+    synthetic.add_argument("--models", nargs="+")
+    synthetic.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,82 @@
+"""Microbenchmark of the SSE frame encoding of /v1/chat_event_streaming.
+
+Encodes the same token stream with the previous per-token path (a
+ChatEventStreaming model, jsonable_encoder and json.dumps) and with the
+precomputed frame template, checks that both produce the same events, and
+reports the cost per frame. With --coalesce-ms the tokens are also grouped
+the way SSE_COALESCE_MS groups them, to show the frames saved per stream.
+
+Usage:
+    python -m benchmarks.bench_sse_encoding --tokens 100000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.common import load_app
+
+app = load_app()
+
+WORDS = ["the", " model", " streams", " token", "s", ",", " ünïcode", " \"quoted\"", "\n", " 😀", " end."]
+
+
+def sample_tokens(count):
+    generator = random.Random(0)
+    return [generator.choice(WORDS) for _ in range(count)]
+
+
+def encode_model(tokens):
+    frames = []
+    for output_tokens, token in enumerate(tokens, start=1):
+        response = app.ChatEventStreaming(event="stream", data=token, is_final=False, output_tokens=output_tokens)
+        frames.append(f"data: {json.dumps(jsonable_encoder(response))}\n\n")
+    return frames
+
+
+def encode_template(tokens):
+    encoder = app.SSEFrameEncoder()
+    return [encoder.frame(token, output_tokens=output_tokens) for output_tokens, token in enumerate(tokens, start=1)]
+
+
+def events(frames):
+    return [json.loads(frame[len("data: "):]) for frame in frames]
+
+
+async def coalesced_frames(tokens, token_interval, window):
+    async def token_stream():
+        for token in tokens:
+            await asyncio.sleep(token_interval)
+            yield token
+
+    return sum([1 async for _batch in app.coalesce_stream(token_stream(), window)])
+
+
+def main(args):
+    tokens = sample_tokens(args.tokens)
+    results = {}
+    for name, encode in (("model", encode_model), ("template", encode_template)):
+        started_at = time.perf_counter()
+        frames = encode(tokens)
+        elapsed = time.perf_counter() - started_at
+        results[name] = (frames, elapsed)
+        print(f"{name:<9} {elapsed / len(tokens) * 1e9:>8.0f}ns/frame {len(tokens) / elapsed:>12.0f} frames/s")
+    assert events(results["model"][0]) == events(results["template"][0]), "the encoders disagree"
+    print(f"speedup: {results['model'][1] / results['template'][1]:.1f}x, orjson={'yes' if app.orjson else 'no'}")
+
+    if args.coalesce_ms:
+        stream_tokens = tokens[:args.stream_tokens]
+        frames = asyncio.run(coalesced_frames(stream_tokens, args.token_interval, args.coalesce_ms / 1000))
+        print(f"coalescing {args.coalesce_ms}ms: {len(stream_tokens)} tokens every {args.token_interval}s sent in {frames} frames")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--coalesce-ms", type=float, default=0)
+    parser.add_argument("--stream-tokens", type=int, default=500)
+    parser.add_argument("--token-interval", type=float, default=0.002)
+    main(parser.parse_args())
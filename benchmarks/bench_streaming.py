@@ -0,0 +1,156 @@
+"""Load benchmark for /v1/chat_event_streaming against a fake LLM.
+
+Compares the async streaming path with the previous synchronous generator,
+which Starlette drives through its threadpool, one worker per live stream.
+
+Usage:
+    python -m benchmarks.bench_streaming --concurrency 10 100 1000
+"""
+import argparse
+import asyncio
+import functools
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from langchain.memory import ConversationBufferMemory
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+
+from benchmarks.common import load_app, percentile
+from benchmarks.fakes import FakeStreamingChatModel
+
+app = load_app()
+
+FAKE_MODEL = "fake-llm"
+DB_LATENCY = 0.03
+
+
+def blocking_round_trip(*_args, result=None, **_kwargs):
+    """Stand-in for a Firestore call, blocks the calling thread for one round trip."""
+    time.sleep(DB_LATENCY)
+    return result
+
+
+def install_fakes(args):
+    """Replace the provider and Firestore calls with latency-injecting fakes."""
+    app.model_company_mapping[FAKE_MODEL] = {
+        "model": functools.partial(FakeStreamingChatModel, ttft=args.ttft, token_interval=args.token_interval, num_tokens=args.tokens),
+        "premium": False,
+        "company": "OpenAI",
+        "input_token_cost_per_million": 0.5,
+        "output_token_cost_per_million": 1.5,
+        "context_window": 16385,
+    }
+
+    global DB_LATENCY
+    DB_LATENCY = args.db_latency
+
+    async def cached_remaining(_google_user_id):
+        return 100
+
+    app.generation_quota.cached_remaining = cached_remaining
+    app.generation_quota.reserve = functools.partial(blocking_round_trip, result=99)
+    app.allocate_chat_id = lambda _chat_id, _google_user_id: ("benchmark-chat", True)
+    app.persistence_queue.submit = lambda _turn: None
+    # every stream starts a chat, its title would be a real gpt-4o-mini call
+    app.TITLE_IN_BACKGROUND = False
+    # every stream of a level is admitted at once, the benchmark measures the streaming path
+    app.admission_controller.limits[app.model_provider(app.model_company_mapping[FAKE_MODEL])] = max(args.concurrency)
+
+
+async def legacy_chat_event_streaming(request, token_info):
+    """The synchronous generator implementation the async path replaced.
+
+    Generations were read before and written after the stream, both blocking.
+    """
+    chat_config = app.model_company_mapping.get(request.chat_model)
+    generations_left = blocking_round_trip(result=100)
+    chat = chat_config['model'](model_name=request.chat_model, model=request.chat_model, temperature=request.temperature)
+    prompt = ChatPromptTemplate(
+        messages=[
+            MessagesPlaceholder(variable_name="chat_history"),
+            HumanMessagePromptTemplate.from_template("{user_input}"),
+        ]
+    )
+    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+    conversation = prompt | chat | StrOutputParser()
+    for chat_history in request.chat_history:
+        memory.chat_memory.add_user_message(chat_history.user_message)
+        memory.chat_memory.add_ai_message(chat_history.ai_message)
+    total_input = prompt.format(chat_history=memory.buffer, user_input=request.user_input)
+
+    def event_streaming():
+        generated_ai_message = ""
+        for token in conversation.stream({"chat_history": memory.buffer, "user_input": request.user_input}):
+            generated_ai_message += token
+            response = app.ChatEventStreaming(event="stream", data=token, is_final=False)
+            yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
+        app.calculate_cost(total_input, generated_ai_message, request.chat_model)
+        # chat lookup, chats update and chat_history add, one after the other
+        for _ in range(3):
+            blocking_round_trip()
+        chat_id = "benchmark-chat"
+        blocking_round_trip(token_info, generations_left - 1)
+        response = app.ChatEventStreaming(event="stream", data="", is_final=True, chat_id=chat_id)
+        yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
+
+    return StreamingResponse(event_streaming(), media_type="text/event-stream")
+
+
+async def run_stream(endpoint, started_at, index):
+    """Run one request to completion and return (time to first token, total time)."""
+    request = app.ChatRequest(user_input="Write a short paragraph", chat_history=[], chat_model=FAKE_MODEL)
+    # a user per stream, a single user would be held to USER_MAX_IN_FLIGHT streams
+    response = await endpoint(request, {"sub": f"benchmark-user-{index}"})
+    first_token_at = None
+    async for _frame in response.body_iterator:
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+    return first_token_at - started_at, time.perf_counter() - started_at
+
+
+async def run_level(endpoint, concurrency):
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(run_stream(endpoint, started_at, index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    ttfts = [ttft for ttft, _ in results]
+    return {
+        "concurrency": concurrency,
+        "streams_per_second": concurrency / elapsed,
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p99": percentile(ttfts, 99),
+        "wall_time": elapsed,
+    }
+
+
+async def main(args):
+    install_fakes(args)
+    implementations = {
+        "legacy-sync": legacy_chat_event_streaming,
+        "async": app.chat_event_streaming,
+    }
+    # A stream counts as served while its p99 TTFT stays within this budget
+    ttft_budget = args.ttft * args.ttft_slack
+    print(f"fake LLM: ttft={args.ttft}s, {args.tokens} tokens every {args.token_interval}s, db round trip={args.db_latency}s")
+    print(f"{'implementation':<14} {'streams':>8} {'streams/s':>10} {'ttft p50':>9} {'ttft p99':>9} {'wall':>8}")
+    for name, endpoint in implementations.items():
+        capacity = 0
+        for concurrency in args.concurrency:
+            result = await run_level(endpoint, concurrency)
+            if result["ttft_p99"] <= ttft_budget:
+                capacity = concurrency
+            print(f"{name:<14} {concurrency:>8} {result['streams_per_second']:>10.1f} {result['ttft_p50']:>8.3f}s {result['ttft_p99']:>8.3f}s {result['wall_time']:>7.2f}s")
+        print(f"{name:<14} capacity within p99 ttft <= {ttft_budget:.2f}s: {capacity} concurrent streams")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100, 500, 1000])
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--db-latency", type=float, default=0.03)
+    parser.add_argument("--ttft-slack", type=float, default=1.5)
+    asyncio.run(main(parser.parse_args()))
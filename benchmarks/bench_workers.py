@@ -0,0 +1,165 @@
+"""Throughput of the gunicorn server as the number of workers grows.
+
+Starts the server with gunicorn.conf.py and 1, 2, 4... uvicorn workers, and
+drives /v1/chat_history and /v1/generations for a fixed time from several
+client processes, so the load generator is not the bottleneck. Reports the
+requests per second, latency percentiles and the scaling over one worker.
+
+The endpoints read Firestore, run the emulator on a machine with spare cores
+or it caps the scaling. More than one worker needs REDIS_URL, without it
+gunicorn.conf.py runs a single worker.
+
+Usage:
+    gcloud emulators firestore start --host-port=localhost:8085
+    FIRESTORE_EMULATOR_HOST=localhost:8085 REDIS_URL=redis://localhost:6379 python -m benchmarks.bench_workers --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import datetime
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+import httpx
+
+from benchmarks.common import benchmark_env, free_port, load_app, percentile
+
+ENDPOINTS = {
+    "chat_history": "/v1/chat_history?limit=10",
+    "generations": "/v1/generations",
+}
+
+
+def seed_users(app, users, chats_per_user):
+    """Create users with a few chats each and return their access tokens."""
+    tokens = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    batch = app.db.batch()
+    writes = 0
+    for _ in range(users):
+        google_user_id = f"workers-benchmark-{uuid.uuid4()}"
+        tokens.append(app.jwt.encode({"sub": google_user_id, "exp": now + datetime.timedelta(hours=1)}, app.SECRET_KEY, algorithm="HS256"))
+        for index in range(chats_per_user):
+            chat_id = str(uuid.uuid4())
+            created_at = now - datetime.timedelta(minutes=index)
+            batch.set(app.db.collection('chats').document(chat_id), {
+                'chat_id': chat_id,
+                'google_user_id': google_user_id,
+                'created_at': created_at,
+                'updated_at': created_at,
+                'model': 'gpt-4o-mini',
+            })
+            writes += 1
+            if writes % 400 == 0:
+                batch.commit()
+                batch = app.db.batch()
+    batch.commit()
+    return tokens
+
+
+def start_server(workers, port, timeout):
+    """Start gunicorn with the given number of workers and wait until it answers."""
+    env = benchmark_env()
+    env.update({"WEB_CONCURRENCY": str(workers), "PORT": str(port), "LOG_LEVEL": "warning"})
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", os.devnull, "app:app"],
+        env=env,
+    )
+    started_at = time.perf_counter()
+    while time.perf_counter() - started_at < timeout:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/openapi.json", timeout=1) as response:
+                if response.status == 200:
+                    return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    server.wait()
+    raise RuntimeError(f"gunicorn with {workers} workers did not answer within {timeout}s")
+
+
+async def drive(url, tokens, connections, duration):
+    """Send requests over the connections until duration is over, return the latencies and errors."""
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def connection(client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            headers = {"Authorization": f"Bearer {random.choice(tokens)}"}
+            started_at = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started_at)
+
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(connection(client) for _ in range(connections)))
+    return latencies, errors
+
+
+def client_process(url, tokens, connections, duration):
+    return asyncio.run(drive(url, tokens, connections, duration))
+
+
+def run_level(pool, url, tokens, args):
+    """Load url from every client process at once and return the combined results."""
+    per_client = max(1, args.connections // args.clients)
+    results = pool.starmap(client_process, [(url, tokens, per_client, args.duration)] * args.clients)
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    return {
+        "requests_per_second": len(latencies) / args.duration,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "errors": sum(errors for _, errors in results),
+    }
+
+
+def main(args):
+    app = load_app()
+    if app.REDIS_URL is None and max(args.workers) > 1:
+        raise SystemExit("REDIS_URL is not set, gunicorn would run a single worker at every level")
+    tokens = seed_users(app, args.users, args.chats_per_user)
+    print(f"{args.users} users with {args.chats_per_user} chats, {args.connections} connections from {args.clients} client processes, {args.duration}s per run")
+    print(f"{'endpoint':<13} {'workers':>8} {'req/s':>9} {'scaling':>8} {'p50':>9} {'p99':>9} {'errors':>7}")
+
+    baseline = {}
+    # Spawned clients do not inherit the app imported above
+    with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+        for workers in args.workers:
+            port = free_port()
+            server = start_server(workers, port, args.timeout)
+            try:
+                for name, path in ENDPOINTS.items():
+                    url = f"http://127.0.0.1:{port}{path}"
+                    # Warm the connections, caches and tokenizers before measuring
+                    run_level(pool, url, tokens, argparse.Namespace(**{**vars(args), "duration": 1}))
+                    result = run_level(pool, url, tokens, args)
+                    baseline.setdefault(name, result["requests_per_second"] / workers)
+                    scaling = result["requests_per_second"] / baseline[name] if baseline[name] else 0.0
+                    print(f"{name:<13} {workers:>8} {result['requests_per_second']:>9.1f} {scaling:>7.2f}x {result['p50'] * 1000:>7.2f}ms {result['p99'] * 1000:>7.2f}ms {result['errors']:>7}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--chats-per-user", type=int, default=20)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    main(parser.parse_args())
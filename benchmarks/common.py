@@ -0,0 +1,51 @@
+"""Shared helpers for the benchmark scripts."""
+import os
+import socket
+import statistics
+
+
+# Placeholder settings the app reads at import time, none of them are used
+# once the external services are replaced by fakes.
+BENCHMARK_ENV = {
+    "SECRET_KEY": "benchmark-secret",
+    "GOOGLE_CLIENT_ID": "benchmark-client-id",
+    "GOOGLE_CLIENT_SECRET": "benchmark-client-secret",
+    "ANTHROPIC_API_KEY": "benchmark-key",
+    "OPENAI_API_KEY": "benchmark-key",
+    "GOOGLE_CLOUD_PROJECT": "chat-with-llms-benchmark",
+    "FIRESTORE_EMULATOR_HOST": "localhost:8085",
+    "ENVIRONMENT": "benchmark",
+}
+
+
+def benchmark_env():
+    """Return the environment with the placeholder settings filled in."""
+    env = os.environ.copy()
+    for key, value in BENCHMARK_ENV.items():
+        env.setdefault(key, value)
+    return env
+
+
+def load_app():
+    """Import the FastAPI app module with placeholder settings for offline runs."""
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+
+    import app
+    return app
+
+
+def free_port():
+    """Return a free local TCP port for a benchmark server."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values using linear interpolation."""
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[min(max(int(pct), 1), 99) - 1]
@@ -0,0 +1,320 @@
+"""Fake providers and an in-memory Firestore used by the benchmarks instead of the real services."""
+import asyncio
+import collections
+import copy
+import datetime
+import random
+import threading
+import time
+import types
+import uuid
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Chat model that streams a fixed number of tokens with configurable latency.
+
+    Accepts the same constructor arguments the app passes to real providers,
+    so it can be dropped into ``model_company_mapping`` directly.
+    """
+
+    model_name: str = "fake-llm"
+    model: str = "fake-llm"
+    temperature: float = 0.0
+    ttft: float = 0.2
+    token_interval: float = 0.01
+    num_tokens: int = 64
+    # Share of the requests failing before their first token, like an overloaded provider
+    failure_rate: float = 0.0
+    # Share of the requests whose first token takes tail_ttft instead of ttft
+    tail_rate: float = 0.0
+    tail_ttft: float = 2.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _first_token_delay(self) -> float:
+        if self.tail_rate and random.random() < self.tail_rate:
+            return self.tail_ttft
+        return self.ttft
+
+    def _maybe_fail(self) -> None:
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError(f"{self.model_name} is overloaded")
+
+    def _tokens(self) -> List[str]:
+        return [f" token{i}" for i in range(self.num_tokens)]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._first_token_delay())
+        self._maybe_fail()
+        time.sleep(self.token_interval * max(self.num_tokens - 1, 0))
+        message = AIMessage(content="".join(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._first_token_delay())
+        self._maybe_fail()
+        for index, token in enumerate(self._tokens()):
+            if index:
+                time.sleep(self.token_interval)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail()
+        for index, token in enumerate(self._tokens()):
+            if index:
+                await asyncio.sleep(self.token_interval)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeIncrement:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeFieldPath:
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def to_api_repr(self):
+        return ".".join(self.parts)
+
+    @staticmethod
+    def document_id():
+        return "__name__"
+
+
+def fake_transactional(function):
+    """Run the function under the database lock and commit its writes, like a transaction without contention."""
+    def run(transaction, *args, **kwargs):
+        with transaction.db.lock:
+            result = function(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return run
+
+
+# Replaces the google.cloud.firestore module the app uses for its sentinels and decorators
+fake_firestore_module = types.SimpleNamespace(
+    SERVER_TIMESTAMP=object(),
+    Increment=FakeIncrement,
+    FieldPath=FakeFieldPath,
+    Query=types.SimpleNamespace(ASCENDING="ASCENDING", DESCENDING="DESCENDING"),
+    transactional=fake_transactional,
+)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field) if self._data else None
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection, document_id):
+        self.db = db
+        self.collection = collection
+        self.id = document_id
+
+    def get(self, field_paths=None, transaction=None):
+        # reads in a transaction hold the database lock, they do not wait for the latency
+        self.db.round_trip(wait=transaction is None)
+        self.db.ops['reads'] += 1
+        with self.db.lock:
+            data = self.db.documents[self.collection].get(self.id)
+            if data is not None and field_paths is not None:
+                data = {field: data[field] for field in field_paths if field in data}
+            return FakeSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data, merge=False):
+        self.db.round_trip()
+        self.db.write([(self, "set", data, merge)])
+
+    def update(self, data):
+        self.db.round_trip()
+        self.db.write([(self, "update", data, False)])
+
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), orders=(), limit=None, offset=0, cursor=None):
+        self.db = db
+        self.collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit, 'offset': self._offset, 'cursor': self._cursor}
+        state.update(changes)
+        return FakeQuery(self.db, self.collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def offset(self, count):
+        return self._copy(offset=count)
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    @staticmethod
+    def _value(document_id, data, field_path):
+        if field_path == "__name__":
+            return document_id
+        return data.get(field_path)
+
+    def _matches(self, data):
+        for field_path, op_string, value in self._filters:
+            if op_string != "==":
+                raise NotImplementedError(f"FakeQuery supports == filters only, not {op_string}")
+            if data.get(field_path) != value:
+                return False
+        return True
+
+    def _after_cursor(self, document_id, data):
+        for field_path, direction in self._orders:
+            cursor_value = self._cursor[field_path]
+            if isinstance(cursor_value, FakeDocumentReference):
+                cursor_value = cursor_value.id
+            value = self._value(document_id, data, field_path)
+            if value != cursor_value:
+                return value < cursor_value if direction == "DESCENDING" else value > cursor_value
+        return False
+
+    def stream(self):
+        self.db.round_trip()
+        with self.db.lock:
+            documents = [(document_id, copy.deepcopy(data)) for document_id, data in self.db.documents[self.collection].items() if self._matches(data)]
+        for field_path, direction in reversed(self._orders):
+            documents.sort(key=lambda item: self._value(item[0], item[1], field_path), reverse=direction == "DESCENDING")
+        if self._cursor is not None:
+            documents = [(document_id, data) for document_id, data in documents if self._after_cursor(document_id, data)]
+        documents = documents[self._offset:]
+        if self._limit is not None:
+            documents = documents[:self._limit]
+        # skipped documents are billed, and a query returning nothing costs one read
+        self.db.ops['reads'] += max(1, len(documents) + self._offset)
+        for document_id, data in documents:
+            yield FakeSnapshot(FakeDocumentReference(self.db, self.collection, document_id), data)
+
+
+class FakeCollection(FakeQuery):
+    def document(self, document_id=None):
+        return FakeDocumentReference(self.db, self.collection, document_id or uuid.uuid4().hex)
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference, "set", data, merge))
+
+    def update(self, reference, data):
+        self._writes.append((reference, "update", data, False))
+
+    def commit(self):
+        self.db.round_trip()
+        self.db.write(self._writes)
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    def commit(self):
+        if self._writes:
+            super().commit()
+
+
+class FakeFirestore:
+    """In-memory stand-in for the Firestore client, counting round trips and billed reads and writes.
+
+    Supports the calls the app makes: documents, == filters, ordering, limits,
+    offsets and cursors, write batches and transactions, Increment and
+    SERVER_TIMESTAMP (with fake_firestore_module installed as the app's
+    google_firestore). Every round trip blocks the calling thread for latency
+    seconds, like the real client.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.documents = collections.defaultdict(dict)
+        self.lock = threading.RLock()
+        self.ops = collections.Counter()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def round_trip(self, wait=True):
+        self.ops['round_trips'] += 1
+        if self.latency and wait:
+            time.sleep(self.latency)
+
+    def _resolve(self, current, value, merge=False):
+        if value is fake_firestore_module.SERVER_TIMESTAMP:
+            return datetime.datetime.now(datetime.timezone.utc)
+        if isinstance(value, FakeIncrement):
+            return (current or 0) + value.value
+        if isinstance(value, dict):
+            # merged sets merge nested maps field by field, as Firestore does
+            merged = dict(current) if merge and isinstance(current, dict) else {}
+            for key, item in value.items():
+                merged[key] = self._resolve(merged.get(key), item, merge)
+            return merged
+        return value
+
+    def write(self, writes):
+        with self.lock:
+            for reference, kind, data, merge in writes:
+                self.ops['writes'] += 1
+                documents = self.documents[reference.collection]
+                current = documents.get(reference.id)
+                if kind == "update" and current is None:
+                    raise KeyError(f"No document to update: {reference.collection}/{reference.id}")
+                if kind == "set" and not merge:
+                    current = {}
+                document = copy.deepcopy(current or {})
+                for key, value in data.items():
+                    # updates address nested fields with dotted paths
+                    parts = key.split(".") if kind == "update" else [key]
+                    target = document
+                    for part in parts[:-1]:
+                        target = target.setdefault(part, {})
+                    target[parts[-1]] = self._resolve(target.get(parts[-1]), value, merge)
+                documents[reference.id] = document
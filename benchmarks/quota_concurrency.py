@@ -0,0 +1,70 @@
+"""Concurrency check of the generations quota against the Firestore emulator.
+
+Fires many reservations and refunds for the same user at once and verifies
+that no generation is lost or spent twice.
+
+Usage:
+    gcloud emulators firestore start --host-port=localhost:8085
+    FIRESTORE_EMULATOR_HOST=localhost:8085 python -m benchmarks.quota_concurrency
+"""
+import argparse
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import load_app
+
+app = load_app()
+
+
+def set_remaining(google_user_id, remaining_generations):
+    app.db.collection('user_generations').document(google_user_id).set({
+        'google_user_id': google_user_id,
+        'remaining_generations': remaining_generations,
+    })
+
+
+def stored_remaining(google_user_id):
+    return app.db.collection('user_generations').document(google_user_id).get().to_dict()['remaining_generations']
+
+
+def check_reservations(quota, requests, workers):
+    google_user_id = f"quota-check-{uuid.uuid4()}"
+    set_remaining(google_user_id, quota)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda _: app.generation_quota.reserve(google_user_id), range(requests)))
+    granted = sum(result is not None for result in results)
+    remaining = stored_remaining(google_user_id)
+    expected_granted = min(quota, requests)
+    print(f"reserve: quota={quota} requests={requests} granted={granted} remaining={remaining}")
+    return granted == expected_granted and remaining == quota - granted
+
+
+def check_refunds(refunds, workers):
+    google_user_id = f"quota-check-{uuid.uuid4()}"
+    set_remaining(google_user_id, 0)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda _: app.generation_quota.refund(google_user_id), range(refunds)))
+    remaining = stored_remaining(google_user_id)
+    print(f"refund: refunds={refunds} remaining={remaining}")
+    return remaining == refunds
+
+
+def main(args):
+    checks = [
+        check_reservations(args.quota, args.requests, args.workers),
+        check_reservations(args.requests * 2, args.requests, args.workers),
+        check_refunds(args.requests, args.workers),
+    ]
+    if not all(checks):
+        print("FAILED: quota was lost or double spent")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quota", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=32)
+    main(parser.parse_args())
@@ -0,0 +1,58 @@
+"""
+Gunicorn settings of the production server.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Runs one uvicorn worker per CPU core (WEB_CONCURRENCY overrides the count).
+The app is imported once in the master before the workers are forked. The
+provider SDKs are imported on first use, so with several workers when_ready
+imports them in the master, and with TOKENIZER_PRELOAD loads the tokenizers;
+both are then shared copy-on-write instead of being loaded by every worker.
+
+Each worker keeps its own event loop, provider and Google HTTP clients and
+persistence queue, which are all created lazily after the fork. State that has
+to agree between the workers (quota, chat owners, Google tokens, histories,
+responses and titles) is stored in the caches made by create_cache, shared
+through REDIS_URL. Without it the server runs a single worker, as the workers
+would answer from their own stale copies. Metrics, traces and the provider
+health are per worker.
+"""
+import multiprocessing
+import os
+
+import dotenv
+
+# REDIS_URL may come from the .env file the app reads
+dotenv.load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+requested_workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+workers = requested_workers if os.getenv("REDIS_URL") else 1
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# Streams can last minutes, a worker is only restarted when it stops answering the master
+timeout = int(os.getenv("GUNICORN_TIMEOUT") or 120)
+# Time left to the running streams and the persistence queue on restarts and deploys
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT") or 30)
+keepalive = 75
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+# The Hugging Face tokenizers loaded in the master would otherwise warn in every forked worker
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def when_ready(server):
+    """Import the provider SDKs and load the tokenizers in the master, before the workers are forked."""
+    import app
+
+    if workers > 1:
+        for model_name in app.model_company_mapping:
+            app.resolve_model_class(model_name)
+    if app.TOKENIZER_PRELOAD:
+        app.tokenizer_registry.preload()
+    if workers < requested_workers:
+        server.log.warning("REDIS_URL is not set, running 1 worker instead of %s so the caches are not split between workers", requested_workers)